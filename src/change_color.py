@@ -6,6 +6,7 @@ import numpy as np
 
 from os import listdir
 from os.path import isfile, join
+from dataset.bg_color import dominant_color, mask_background, load_color_table
 
 path = "/data/ATARI/"
 # just change to the game you want to create your greyscale images
@@ -14,6 +15,11 @@ game = "Pong-v0"
 
 suffix = "-black"
 
+# background colors of the game, cv2 images are BGR
+bg_colors = load_color_table(os.getcwd() + path, game)
+if bg_colors is not None:
+    bg_colors = bg_colors[:, ::-1]
+
 # folders inside game folder
 folders = ["train/" , "test/", "validation/"]
 
@@ -27,14 +33,9 @@ for folder in folders:
         img_path = join(mypath,onlyfiles[n])
         tmp_img = cv2.imread(img_path)
         # get most dominant color
-        colors, count = np.unique(tmp_img.reshape(-1,tmp_img.shape[-1]), axis=0, return_counts=True)
-        most_dominant_color = colors[count.argmax()]
+        most_dominant_color = dominant_color(tmp_img, bg_colors)
         # create the mask and use it to change the colors
-        bounds_size = 20
-        lower = most_dominant_color - [bounds_size, bounds_size, bounds_size]
-        upper = most_dominant_color + [bounds_size, bounds_size, bounds_size]
-        mask = cv2.inRange(tmp_img, lower, upper)
-        tmp_img[mask != 0] = [0,0,0]
+        mask_background(tmp_img, most_dominant_color, bounds_size=20)
         # dilation 
         kernel = np.ones((3,3), np.uint8)
         img_dilation = cv2.dilate(tmp_img, kernel, iterations=1)
@@ -16,6 +16,11 @@ cfg = CfgNode({
     # Device ids to use
     'device_ids': [0, 1],
     'device': 'cuda:0',
+    # Multi-process training with DistributedDataParallel. Launch with torchrun, or set world_size to
+    # spawn that many local processes. With cuda, rank i uses cuda:i. gloo also works on cpu
+    'distributed': False,
+    'world_size': 1,
+    'dist_backend': 'gloo',
     'logdir': '../output/logs/',
     'checkpointdir': '../output/checkpoints/',
     'evaldir': '../output/eval/',
@@ -29,6 +34,8 @@ cfg = CfgNode({
         'OBJ3D_LARGE': '../data/OBJ3D_LARGE',
         'OBJ3D_SMALL': '../data/OBJ3D_SMALL',
     },
+    # Datasets return uint8 frames, which are normalized on the device. See dataset.preprocess_batch
+    'uint8_frames': False,
 
     # For Atari
     'gamelist': [
@@ -45,6 +52,8 @@ cfg = CfgNode({
         'Pong-v0',
         'Tennis-v0',
     ],
+    # Read frames from the uint8 arrays written by pack_dataset.py instead of decoding PNGs
+    'packed_dataset': False,
 
 
     # For engine.train
@@ -57,11 +66,20 @@ cfg = CfgNode({
         # Gradient clipping. If 0.0 we don't clip
         'clip_norm': 1.0,
         'max_ckpt': 5,
+        # Write checkpoints on a background thread
+        'async_save': False,
 
         'print_every': 500,
+        # Write the visualization on a background thread, dropping steps while it is busy
+        'vis_async': False,
+        'vis_queue_size': 2,
+        # Resolution of the visualized images. 0 for the input resolution
+        'vis_size': 0,
         'save_every': 1000,
         'eval_on': True,
         'eval_every': 1000,
+        # Evaluate in a separate process while training continues
+        'eval_async': False,
 
         'solver': {
             'fg': {
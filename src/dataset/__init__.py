@@ -1,9 +1,12 @@
 from .atari import Atari
 from .obj3d import Obj3D
+from .preprocess import preprocess_batch, preprocess_flags
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+import torch.distributed as dist
 
 
-__all__ = ['get_dataset', 'get_dataloader']
+__all__ = ['get_dataset', 'get_dataloader', 'preprocess_batch', 'preprocess_flags']
 
 def get_dataset(cfg, mode):
     assert mode in ['train', 'val', 'test']
@@ -11,9 +14,9 @@ def get_dataset(cfg, mode):
         mode = 'validation' if mode == 'val' else mode
         return Atari(cfg.dataset_roots.ATARI, mode, cfg, gamelist=cfg.gamelist)
     elif cfg.dataset == 'OBJ3D_SMALL':
-        return Obj3D(cfg.dataset_roots.OBJ3D_SMALL, mode)
+        return Obj3D(cfg.dataset_roots.OBJ3D_SMALL, mode, uint8=cfg.uint8_frames)
     elif cfg.dataset == 'OBJ3D_LARGE':
-        return Obj3D(cfg.dataset_roots.OBJ3D_LARGE, mode)
+        return Obj3D(cfg.dataset_roots.OBJ3D_LARGE, mode, uint8=cfg.uint8_frames)
 
 def get_dataloader(cfg, mode):
     assert mode in ['train', 'val', 'test']
@@ -23,7 +26,12 @@ def get_dataloader(cfg, mode):
     num_workers = getattr(cfg, mode).num_workers
     
     dataset = get_dataset(cfg, mode)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+    # Each rank gets its own shard. batch_size is per rank
+    sampler = None
+    if mode == 'train' and dist.is_available() and dist.is_initialized():
+        sampler = DistributedSampler(dataset, shuffle=shuffle)
+        shuffle = False
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, sampler=sampler)
     
     return dataloader
     
@@ -6,6 +6,8 @@ import numpy as np
 from torch.utils.data import Dataset
 from PIL import Image
 import PIL
+from .packed import read_index, open_frames
+from .bg_color import dominant_color, mask_background, load_color_table
 
 class Atari(Dataset):
     def __init__(self, root, mode, cfg, gamelist=None):
@@ -13,34 +15,80 @@ class Atari(Dataset):
 
         # self.image_path = os.checkpointdir.join(root, f'{key_word}')
         self.image_path = root
+        self.mode = mode
 
-        image_fn = [os.path.join(fn, mode, img) for fn in os.listdir(root) \
-                    if gamelist is None or fn in gamelist \
-                    for img in os.listdir(os.path.join(root, fn, mode))]
-        self.image_fn = image_fn
-        self.image_fn.sort()
-        # preprocessing flags
-        self.black_bg = getattr(cfg, mode).black_background
-        self.dilation = getattr(cfg, mode).dilation
+        self.packed = cfg.packed_dataset
+        if self.packed:
+            # Same order as the sorted file names below
+            self.games = sorted((fn for fn in os.listdir(root) if gamelist is None or fn in gamelist),
+                                key=lambda fn: fn + os.sep)
+            self.image_fn = []
+            game_sizes = []
+            for game in self.games:
+                index = read_index(root, game, mode)
+                if index is None:
+                    raise FileNotFoundError(f'No packed {mode} split for {game} in {root}. Run pack_dataset.py first.')
+                self.image_fn.extend(os.path.join(game, mode, img) for img in index['files'])
+                game_sizes.append(len(index['files']))
+            # Index into self.image_fn where each game starts
+            self.game_offsets = np.cumsum([0] + game_sizes)
+            # Opened lazily in each worker
+            self.frames = None
+        else:
+            image_fn = [os.path.join(fn, mode, img) for fn in os.listdir(root) \
+                        if gamelist is None or fn in gamelist \
+                        for img in os.listdir(os.path.join(root, fn, mode))]
+            self.image_fn = image_fn
+            self.image_fn.sort()
+        # preprocessing flags. There are only training flags, the other splits are preprocessed the same way
+        self.black_bg = cfg.train.black_background
+        self.dilation = cfg.train.dilation
+        # Return uint8 frames and leave the preprocessing to dataset.preprocess_batch
+        self.uint8 = cfg.uint8_frames
+        # Background colors of each game, see pack_dataset.py --bg-colors
+        self.color_tables = {}
+        if self.black_bg:
+            for game in {fn.split(os.sep)[0] for fn in self.image_fn}:
+                self.color_tables[game] = load_color_table(root, game)
+
+    def __getstate__(self):
+        # Don't pickle memory maps into DataLoader workers
+        state = self.__dict__.copy()
+        if self.packed:
+            state['frames'] = None
+        return state
+
+    def load_frame(self, index):
+        """
+        :return: (128, 128, 3) uint8 array. Might be a view into the memory map
+        """
+        if self.packed:
+            if self.frames is None:
+                self.frames = [open_frames(self.image_path, game, self.mode) for game in self.games]
+            game = np.searchsorted(self.game_offsets, index, side='right') - 1
+            return self.frames[game][index - self.game_offsets[game]]
 
-    def __getitem__(self, index):
         fn = self.image_fn[index]
 
         pil_img = Image.open(os.path.join(self.image_path, fn)).convert('RGB')
         pil_img = pil_img.resize((128, 128), PIL.Image.BILINEAR)
+        return np.array(pil_img)
+
+    def __getitem__(self, index):
         # convert image to opencv
-        opencv_img = np.asarray(pil_img).copy()
+        opencv_img = self.load_frame(index)
+        if self.uint8:
+            # (3, H, W)
+            return torch.from_numpy(opencv_img).permute(2, 0, 1)
         if self.black_bg:
+            # Never write into the memory map
+            opencv_img = opencv_img.copy()
             # get most dominant color
-            colors, count = np.unique(opencv_img.reshape(-1,opencv_img.shape[-1]), axis=0, return_counts=True)
-            most_dominant_color = colors[count.argmax()]
+            game = self.image_fn[index].split(os.sep)[0]
+            most_dominant_color = dominant_color(opencv_img, self.color_tables[game])
             # create the mask and use it to change the colors
-            bounds_size = 20
-            lower = most_dominant_color - [bounds_size, bounds_size, bounds_size]
-            upper = most_dominant_color + [bounds_size, bounds_size, bounds_size]
-            mask = cv2.inRange(opencv_img, lower, upper)
-            opencv_img[mask != 0] = [0,0,0]
-        # dilation 
+            mask_background(opencv_img, most_dominant_color, bounds_size=20)
+        # dilation
         if self.dilation:
             kernel = np.ones((3,3), np.uint8)
             opencv_img = cv2.dilate(opencv_img, kernel, iterations=1)
@@ -0,0 +1,83 @@
+import os
+import os.path as osp
+import json
+import numpy as np
+import cv2
+
+# Background colors of root/game are stored in root/game/bg_colors.json, as RGB
+COLOR_TABLE_NAME = 'bg_colors.json'
+
+
+def color_keys(img):
+    """
+    :param img: (H, W, 3) uint8
+    :return: (H*W,) int, one key per color
+    """
+    img = img.reshape(-1, 3).astype(np.int32)
+    return img[:, 0] << 16 | img[:, 1] << 8 | img[:, 2]
+
+
+def dominant_color(img, table=None):
+    """
+    Most frequent color of an image. Same as np.unique(img.reshape(-1, 3), axis=0, return_counts=True),
+    including ties, which go to the smallest color.
+
+    A table color that covers more than half of the image has to be the most frequent one. Otherwise
+    we count all colors.
+
+    :param img: (H, W, 3) uint8
+    :param table: (K, 3) uint8 candidate colors in the channel order of img, most likely first
+    :return: (3,) uint8
+    """
+    keys = color_keys(img)
+    if table is not None:
+        for color, key in zip(table, color_keys(table)):
+            if np.count_nonzero(keys == key) * 2 > keys.size:
+                return color
+    colors, inverse = np.unique(keys, return_inverse=True)
+    key = colors[np.bincount(inverse.ravel()).argmax()]
+    return np.array([key >> 16, (key >> 8) & 255, key & 255], dtype=np.uint8)
+
+
+def mask_background(img, color, bounds_size=20):
+    """
+    Set pixels within bounds_size of color to black, in place
+
+    :param img: (H, W, 3) uint8
+    :param color: (3,) uint8
+    """
+    lower = color.astype(np.int32) - bounds_size
+    upper = color.astype(np.int32) + bounds_size
+    mask = cv2.inRange(img, lower, upper)
+    img[mask != 0] = [0, 0, 0]
+    return img
+
+
+def build_color_table(frames, max_colors=4):
+    """
+    :param frames: iterable of (H, W, 3) uint8 images
+    :return: (K, 3) uint8, the colors that are most often dominant, most often first
+    """
+    keys = np.array([color_keys(dominant_color(frame)[None])[0] for frame in frames])
+    if keys.size == 0:
+        return np.zeros((0, 3), dtype=np.uint8)
+    colors, count = np.unique(keys, return_counts=True)
+    colors = colors[np.argsort(-count, kind='stable')][:max_colors]
+    return np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1).astype(np.uint8)
+
+
+def save_color_table(root, game, table):
+    with open(osp.join(root, game, COLOR_TABLE_NAME), 'w') as f:
+        json.dump({'colors': table.tolist()}, f)
+
+
+def load_color_table(root, game):
+    """
+    :return: (K, 3) uint8 RGB colors, None if there is no table for this game
+    """
+    path = osp.join(root, game, COLOR_TABLE_NAME)
+    if not osp.exists(path):
+        return None
+    with open(path) as f:
+        colors = json.load(f)['colors']
+    return np.array(colors, dtype=np.uint8).reshape(-1, 3)
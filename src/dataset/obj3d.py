@@ -11,11 +11,13 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
 class Obj3D(Dataset):
-    def __init__(self, root, mode):
+    def __init__(self, root, mode, uint8=False):
         # checkpointdir = os.checkpointdir.join(root, mode)
         assert mode in ['train', 'val', 'test']
         self.root = root
         self.mode = mode
+        # Return uint8 frames and leave the normalization to dataset.preprocess_batch
+        self.uint8 = uint8
         assert os.path.exists(root), 'Path {} does not exist'.format(root)
         
         
@@ -38,6 +40,13 @@ class Obj3D(Dataset):
     def __getitem__(self, index):
         img_path = self.img_paths[index]
         img = io.imread(img_path)[:, :, :3]
+        if self.uint8:
+            transform = transforms.Compose([
+                transforms.ToPILImage(),
+                transforms.Resize(128),
+            ])
+            # (3, H, W)
+            return torch.from_numpy(np.array(transform(img))).permute(2, 0, 1)
         transform = transforms.Compose([
             transforms.ToPILImage(),
             transforms.Resize(128),
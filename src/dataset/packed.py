@@ -0,0 +1,72 @@
+import os
+import os.path as osp
+import json
+import numpy as np
+from PIL import Image
+import PIL
+
+# Packed frames of root/game/mode/*.png are stored in root/game/mode.npy, the index in root/game/mode.json
+PACKED_VERSION = 1
+
+
+def packed_paths(root, game, mode):
+    """
+    :return: path of the frame array, path of the index
+    """
+    return osp.join(root, game, f'{mode}.npy'), osp.join(root, game, f'{mode}.json')
+
+
+def pack_split(root, game, mode, size=128):
+    """
+    Decode and resize every frame of root/game/mode once and write them into one uint8 (N, size, size, 3) array.
+    Frames are stored in the same order as dataset.Atari lists them.
+
+    The index is written last, so a split only counts as packed when the array is complete.
+    """
+    image_dir = osp.join(root, game, mode)
+    image_fn = sorted(os.listdir(image_dir))
+    array_path, index_path = packed_paths(root, game, mode)
+    if osp.exists(index_path):
+        os.remove(index_path)
+    frames = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8, shape=(len(image_fn), size, size, 3))
+    for i, fn in enumerate(image_fn):
+        pil_img = Image.open(osp.join(image_dir, fn)).convert('RGB')
+        pil_img = pil_img.resize((size, size), PIL.Image.BILINEAR)
+        frames[i] = np.asarray(pil_img)
+    frames.flush()
+    del frames
+
+    index = {
+        'version': PACKED_VERSION,
+        'files': image_fn,
+        'shape': [len(image_fn), size, size, 3],
+        'dtype': 'uint8',
+    }
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def read_index(root, game, mode):
+    """
+    :return: the index of a packed split, or None if the split is not packed
+    """
+    _, index_path = packed_paths(root, game, mode)
+    if not osp.exists(index_path):
+        return None
+    with open(index_path) as f:
+        index = json.load(f)
+    if index.get('version') != PACKED_VERSION:
+        return None
+    return index
+
+
+def open_frames(root, game, mode):
+    """
+    Memory map a packed split. Copy-on-write, so that slices can be handed to torch without copying
+    and writes never reach the file.
+
+    :return: (N, H, W, 3) uint8 array
+    """
+    array_path, _ = packed_paths(root, game, mode)
+    return np.load(array_path, mmap_mode='c')
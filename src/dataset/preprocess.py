@@ -0,0 +1,82 @@
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+
+def preprocess_flags(dataset):
+    """
+    Preprocessing a dataset leaves to preprocess_batch when it returns uint8 frames
+    """
+    tables = [table for table in getattr(dataset, 'color_tables', {}).values() if table is not None]
+    return {
+        'black_background': getattr(dataset, 'black_bg', False),
+        'dilation': getattr(dataset, 'dilation', False),
+        # A color covering more than half of an image is its most frequent one whatever its game, so the
+        # union of the tables gives the same result as the table of each image's game
+        'bg_colors': np.concatenate(tables) if tables else None,
+    }
+
+
+def preprocess_batch(imgs, device, black_background=False, dilation=False, bg_colors=None, bounds_size=20):
+    """
+    Move a batch to the device and normalize it. Float batches are already preprocessed by the dataset
+    and only moved. uint8 batches are normalized on the device, with the same background masking and
+    dilation as dataset.Atari.
+
+    :param imgs: (B, 3, H, W), uint8 in [0, 255] or float in [0, 1]
+    :param black_background: set pixels close to the most frequent color of each image to black
+    :param dilation: 3x3 dilation, per channel
+    :param bg_colors: (K, 3) uint8 RGB background color table, see dataset.bg_color
+    :return: (B, 3, H, W), float in [0, 1]
+    """
+    imgs = imgs.to(device, non_blocking=True)
+    if imgs.dtype != torch.uint8:
+        return imgs
+    if black_background:
+        imgs = mask_dominant_color(imgs, bounds_size, bg_colors)
+    imgs = imgs.float()
+    if dilation:
+        # Padding is -inf, so borders are ignored as in cv2.dilate
+        imgs = F.max_pool2d(imgs, kernel_size=3, stride=1, padding=1)
+    return imgs / 255
+
+
+def mask_dominant_color(imgs, bounds_size=20, table=None):
+    """
+    Set pixels within bounds_size of the most frequent color of their image to black (cv2.inRange).
+    Same colors as dataset.bg_color.dominant_color: a table color covering more than half of the image
+    if there is one, otherwise ties go to the smallest color.
+
+    :param imgs: (B, 3, H, W), uint8
+    :param table: (K, 3) uint8 RGB candidate colors
+    :return: (B, 3, H, W), uint8
+    """
+    B = imgs.size(0)
+    colors = imgs.long()
+    # (B, N), one key per RGB color
+    keys = (colors[:, 0] << 16 | colors[:, 1] << 8 | colors[:, 2]).view(B, -1)
+    N = keys.size(1)
+    found = torch.zeros(B, dtype=torch.bool, device=imgs.device)
+    dominant = torch.zeros(B, dtype=torch.long, device=imgs.device)
+    if table is not None and len(table) > 0:
+        table = torch.as_tensor(np.asarray(table), device=imgs.device).long()
+        # (K,), tables of several games can share colors
+        table_keys = torch.unique(table[:, 0] << 16 | table[:, 1] << 8 | table[:, 2])
+        # (B, K), at most one color per image covers more than half of it
+        hits = (keys[:, :, None] == table_keys).sum(dim=1) * 2 > N
+        found = hits.any(dim=1)
+        dominant = (hits.long() * table_keys).sum(dim=1)
+    if not found.all():
+        # (B, N), each key with the size of its run among the sorted keys
+        sorted_keys, _ = keys.sort(dim=1)
+        count = (torch.searchsorted(sorted_keys, sorted_keys, right=True)
+                 - torch.searchsorted(sorted_keys, sorted_keys))
+        # Most frequent, then first in sorted order, so ties go to the smallest key
+        first = (count * N - torch.arange(N, device=imgs.device)).argmax(dim=1)
+        mode = sorted_keys.gather(1, first[:, None])[:, 0]
+        dominant = torch.where(found, dominant, mode)
+    # (B, 3, 1, 1)
+    dominant = torch.stack([dominant >> 16, (dominant >> 8) & 255, dominant & 255], dim=1)[..., None, None]
+    # (B, 1, H, W)
+    mask = ((colors - dominant).abs() <= bounds_size).all(dim=1, keepdim=True)
+    return imgs.masked_fill(mask, 0)
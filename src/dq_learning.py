@@ -15,6 +15,8 @@ from PIL import Image
 import PIL
 import cv2
 import os
+import pickle
+import types
 
 from rtpt import RTPT
 import time
@@ -26,6 +28,7 @@ import torchvision.transforms as T
 import dqn.dqn_saver as saver
 import dqn.dqn_logger
 import dqn.dqn_agent as dqn_agent
+from dqn.dqn_memory import ReplayMemory, PrioritizedReplayMemory
 
 import argparse
 
@@ -37,6 +40,7 @@ from engine.utils import get_config
 from utils import Checkpointer
 from solver import get_optimizers
 from eval.ap import convert_to_boxes
+from dataset.bg_color import dominant_color, mask_background, load_color_table
 
 cfg, task = get_config()
 
@@ -89,23 +93,23 @@ if is_ipython:
 plt.ion()
 
 ### replay memory stuff
+# older checkpoints pickled their replay memory, a __main__.ReplayMemory with a deque of these in .memory.
+# they are loaded with LegacyUnpickler, which reads that class as LegacyReplayMemory
 Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward', 'done'))
 
-class ReplayMemory(object):
+class LegacyReplayMemory(object):
+    pass
 
-    def __init__(self, capacity):
-        self.memory = deque([],maxlen=capacity)
+class LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == '__main__' and name == 'ReplayMemory':
+            return LegacyReplayMemory
+        return super().find_class(module, name)
 
-    def push(self, *args):
-        """Save a transition"""
-        self.memory.append(Transition(*args))
-
-    def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
-
-    def __len__(self):
-        return len(self.memory)
+# for torch.load
+legacy_pickle = types.SimpleNamespace(__name__='pickle', Unpickler=LegacyUnpickler,
+                                      load=lambda f, **kwargs: LegacyUnpickler(f, **kwargs).load())
 
 resize = T.Compose([T.ToPILImage(),
                     T.Resize(40, interpolation=Image.CUBIC),
@@ -120,6 +124,10 @@ video_every = 10
 # preprocessing flags
 black_bg = getattr(cfg, "train").black_background
 dilation = getattr(cfg, "train").dilation
+# background colors of the game, the frames are BGR
+bg_colors = load_color_table(cfg.dataset_roots.ATARI, cfg.gamelist[0])
+if bg_colors is not None:
+    bg_colors = bg_colors[:, ::-1]
 
 def get_screen():
     screen = env.render(mode='rgb_array')
@@ -133,14 +141,9 @@ def get_screen():
     opencv_img = cv2.cvtColor(opencv_img, cv2.COLOR_RGB2BGR)
     if black_bg:
         # get most dominant color
-        colors, count = np.unique(opencv_img.reshape(-1,opencv_img.shape[-1]), axis=0, return_counts=True)
-        most_dominant_color = colors[count.argmax()]
+        most_dominant_color = dominant_color(opencv_img, bg_colors)
         # create the mask and use it to change the colors
-        bounds_size = 20
-        lower = most_dominant_color - [bounds_size, bounds_size, bounds_size]
-        upper = most_dominant_color + [bounds_size, bounds_size, bounds_size]
-        mask = cv2.inRange(opencv_img, lower, upper)
-        opencv_img[mask != 0] = [0,0,0]
+        mask_background(opencv_img, most_dominant_color, bounds_size=20)
     # dilation 
     if dilation:
         kernel = np.ones((3,3), np.uint8)
@@ -217,11 +220,10 @@ def process_z_stuff(z_where, z_pres_prob, z_what):
 
 # use SPACE model
 def get_z_stuff(image):
-    # TODO: treat global_step in a more elegant way
     with torch.no_grad():
-        loss, log = model(image, global_step=100000000)
+        latents = model.encode(image)
         # (B, N, 4), (B, N, 1), (B, N, D)
-        z_where, z_pres_prob, z_what = log['z_where'], log['z_pres_prob'], log['z_what']
+        z_where, z_pres_prob, z_what = latents['z_where'], latents['z_pres_prob'], latents['z_what']
         return process_z_stuff(z_where[0], z_pres_prob[0], z_what[0])
     return None
 
@@ -253,6 +255,8 @@ skip_frames = 1
 
 MEMORY_SIZE = 50000
 MEMORY_MIN_SIZE = 25000
+# sample transitions by their TD error instead of uniformly
+PRIORITIZED_REPLAY = False
 
 # for debugging nn stuff
 if DEBUG:
@@ -271,7 +275,10 @@ logger = dqn.dqn_logger.DQN_Logger(log_path, exp_name)
 
 # Get number of actions from gym action space
 n_actions = env.action_space.n
-memory = ReplayMemory(MEMORY_SIZE)
+if PRIORITIZED_REPLAY:
+    memory = PrioritizedReplayMemory(MEMORY_SIZE, device)
+else:
+    memory = ReplayMemory(MEMORY_SIZE, device)
 
 # init agent
 agent = dqn_agent.Agent(
@@ -296,11 +303,19 @@ if saver.check_loading_model(exp_name):
     # folder and file exists, so load and return
     model_path = saver.model_name(exp_name) 
     print("Loading {}".format(model_path))
-    checkpoint = torch.load(model_path, map_location=torch.device(device))
+    checkpoint = torch.load(model_path, map_location=torch.device(device), pickle_module=legacy_pickle)
     agent.policy_net.load_state_dict(checkpoint['policy_model_state_dict'])
     agent.target_net.load_state_dict(checkpoint['target_model_state_dict'])
     agent.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-    memory = checkpoint['memory']
+    if os.path.isfile(saver.memory_name(exp_name)):
+        memory.load(saver.memory_name(exp_name))
+    elif 'memory' in checkpoint:
+        transitions = list(checkpoint['memory'].memory)
+        # the deque can start in the middle of an episode, whose first frames are gone. skip to the
+        # first full episode, since the memory pads the first stacks pushed with their newest frame
+        dones = [i for i, transition in enumerate(transitions) if transition.done]
+        for transition in transitions[dones[0] + 1 if dones else 0:]:
+            memory.push(*transition)
     i_episode = checkpoint['episode']
     global_step = checkpoint['global_step']
     total_max_q = checkpoint['total_max_q']
@@ -7,15 +7,9 @@ import numpy as np
 import torch.nn.functional as F
 import torch.optim as optim
 
-from collections import namedtuple
-
 from dqn.dqn_networks import LinearNN
 from dqn.dqn_networks import DuelCNN
 
-### replay memory stuff
-Transition = namedtuple('Transition',
-                        ('state', 'action', 'next_state', 'reward', 'done'))
-
 class Agent:
     def __init__(self, batch_size, gamma, eps_start, eps_end, eps_decay, 
                     lr, n_actions, memory_min_size, device, log_steps,  use_space):
@@ -74,23 +68,16 @@ class Agent:
     def optimize_model(self, memory, total_max_q, total_loss, logger, global_step):
         if len(memory) < self.batch_size:
             return total_max_q, total_loss
-        transitions = memory.sample(self.batch_size)
         """
-        zip(*transitions) unzips the transitions into
-        Transition(*) creates new named tuple
-        batch.state - tuple of all the states (each state is a tensor)
-        batch.next_state - tuple of all the next states (each state is a tensor)
-        batch.reward - tuple of all the rewards (each reward is a float)
-        batch.action - tuple of all the actions (each action is an int)    
+        batch.state - (B, 4, ...) stacked states
+        batch.next_state - (B, 4, ...) stacked next states
+        batch.reward - (B,) float rewards
+        batch.action - (B,) long actions
+        batch.done - (B,) 1.0 for terminal transitions
+        batch.weight - (B,) importance sampling weights, None unless memory is prioritized
         """
-        batch = Transition(*zip(*transitions))
-
-        # Convert them to tensors
-        state = torch.from_numpy(np.array(batch.state)).float().to(self.device)
-        next_state = torch.from_numpy(np.array(batch.next_state)).float().to(self.device)
-        action = torch.cat(batch.action, dim=0).to(self.device).squeeze(1)
-        reward = torch.cat(batch.reward, dim=0).to(self.device)
-        done = torch.tensor(batch.done, dtype=torch.float, device=self.device)
+        batch = memory.sample(self.batch_size)
+        state, action, next_state, reward, done = batch.state, batch.action, batch.next_state, batch.reward, batch.done
 
         # Make predictions
         state_q_values = self.policy_net(state)
@@ -106,7 +93,13 @@ class Agent:
         expected_q_value = reward + self.gamma * next_states_target_q_value * (1 - done)
 
         # Calc loss with expected_q_value and q_value
-        loss = F.mse_loss(selected_q_value, expected_q_value.detach())
+        if batch.weight is None:
+            loss = F.mse_loss(selected_q_value, expected_q_value.detach())
+        else:
+            # Prioritized replay: weighted loss, and the TD errors are the new priorities
+            td_error = expected_q_value.detach() - selected_q_value
+            loss = (batch.weight * td_error ** 2).mean()
+            memory.update_priorities(batch.index, td_error.detach().abs().cpu().numpy())
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
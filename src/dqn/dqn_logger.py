@@ -7,7 +7,7 @@ import numpy as np
 
 from torch.utils.tensorboard import SummaryWriter
 
-from utils import draw_bounding_boxes
+from utils import draw_bounding_boxes, draw_boxes
 
 FOLDER_TO_VIDEO = "/dqn/video/"
 PATH_TO_VIDEO = os.getcwd() + FOLDER_TO_VIDEO
@@ -52,15 +52,15 @@ class DQN_Logger:
     # helper function to draw bounding box over z wheres 
     def draw_bounding_box(self, boxes_batch, indices):
         last_frame = self.video_buffer.pop()
-        bb = (boxes_batch[0][:,:4] * (128, 128, 128, 128)).round().astype(int)
+        # (N, 4), [y_min, y_max, x_min, x_max] in pixels
+        bb = torch.from_numpy(boxes_batch[0][:, :4] * 128)
         # blue = dqn, green = ball, red = enemy, random = black
-        color = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 0, 0), (0,0,0)]
-        thickness = 2
-        for single_bb, color_i in zip(bb, indices):
-            start = (single_bb[2], single_bb[0])
-            end = (single_bb[3], single_bb[1])
-            last_frame = cv2.rectangle(last_frame, start, end, color[color_i], thickness)
-        self.video_buffer.append(last_frame)
+        color = torch.tensor([(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 0, 0), (0,0,0)], dtype=torch.uint8)
+        num_boxes = min(len(bb), len(indices))
+        # (1, 3, H, W)
+        frame = torch.from_numpy(last_frame).permute(2, 0, 1)[None]
+        frame = draw_boxes(frame, bb[None, :num_boxes], color[list(indices[:num_boxes])][None], thickness=2)
+        self.video_buffer.append(frame[0].permute(1, 2, 0).contiguous().numpy())
 
     def save_video(self, model_name, fps=25.0):
         if not os.path.exists(PATH_TO_VIDEO):
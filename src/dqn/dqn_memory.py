@@ -0,0 +1,313 @@
+# replay memory for dqn, preallocated tensors used as a ring buffer
+
+import numpy as np
+import torch
+
+from collections import namedtuple
+
+from utils import atomic_save
+
+# A sampled batch of (B, ...) tensors on the device of the memory. Prioritized memories also return the
+# (B,) slots, to update their priorities, and the importance sampling weights
+Batch = namedtuple('Batch', ('state', 'action', 'next_state', 'reward', 'done', 'index', 'weight'),
+                   defaults=(None, None))
+
+
+class ReplayMemory:
+    """
+    Transitions in preallocated cpu tensors. Once capacity is reached the oldest are overwritten. Storage
+    is allocated on the first push, with the shape of its state.
+
+    States are stacks of frames, newest first, of which only the newest is stored. Every frame is stored
+    once instead of once per stack it is in, and the stacks are rebuilt when sampling. As in dq_learning,
+    stacks are padded with the first frame of the episode.
+    """
+
+    def __init__(self, capacity, device='cpu', seed=None):
+        self.capacity = capacity
+        self.device = torch.device(device)
+        self.rng = np.random.RandomState(seed)
+        self.storage = None
+        # Number of frames per state
+        self.history = None
+        # Next slot to write and the number of stored transitions
+        self.position = 0
+        self.size = 0
+
+    def allocate(self, state_shape):
+        self.history = state_shape[0]
+        self.storage = {
+            'frame': torch.zeros((self.capacity, *state_shape[1:]), dtype=torch.float),
+            'action': torch.zeros(self.capacity, dtype=torch.long),
+            'reward': torch.zeros(self.capacity, dtype=torch.float),
+            'done': torch.zeros(self.capacity, dtype=torch.bool),
+            # First transition of an episode
+            'start': torch.zeros(self.capacity, dtype=torch.bool),
+        }
+
+    def push(self, state, action, next_state, reward, done):
+        """
+        Save a transition. Transitions have to be pushed in order, an episode starts after a done one.
+        next_state is not stored, its newest frame is the one of the next state pushed.
+
+        :param state: (H, ...) array or tensor, stacked frames, newest first
+        :param action: int or tensor with one element
+        :param next_state: (H, ...) array or tensor
+        :param reward: float or tensor with one element
+        :param done: bool
+        """
+        state = torch.as_tensor(np.asarray(state), dtype=torch.float)
+        if self.storage is None:
+            self.allocate(state.shape)
+        i = self.position
+        self.storage['start'][i] = self.size == 0 or bool(self.storage['done'][(i - 1) % self.capacity])
+        self.storage['frame'][i] = state[0]
+        self.storage['action'][i] = int(action)
+        self.storage['reward'][i] = float(reward)
+        self.storage['done'][i] = bool(done)
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def stack_index(self, index):
+        """
+        Slots of the frames of the given transitions' states
+
+        A transition is invalid if its next frame isn't stored yet, or if part of its state has already
+        been overwritten.
+
+        :param index: (B,) slots
+        :return:
+            state: (B, H) slots, newest first
+            next_state: (B, H) slots
+            valid: (B,) bool
+        """
+        start = self.storage['start'].numpy()
+        done = self.storage['done'].numpy()
+        oldest = (self.position - self.size) % self.capacity
+        newest = (self.position - 1) % self.capacity
+        # The next frame of a terminal transition is never used
+        valid = done[index] | (index != newest)
+        slots = [index]
+        for _ in range(self.history - 1):
+            slot = slots[-1]
+            at_start = start[slot]
+            valid &= at_start | (slot != oldest)
+            slots.append(np.where(at_start, slot, (slot - 1) % self.capacity))
+        state = np.stack(slots, axis=1)
+        next_frame = np.where(done[index], index, (index + 1) % self.capacity)
+        next_state = np.concatenate([next_frame[:, None], state[:, :-1]], axis=1)
+        return state, next_state, valid
+
+    def sample(self, batch_size):
+        """
+        Uniform sample of valid transitions, with replacement. Without replacement, RandomState.choice
+        permutes the whole memory for every batch.
+
+        :return: Batch
+        """
+        index = self.rng.randint(self.size, size=batch_size)
+        valid = self.stack_index(index)[2]
+        if not valid.all():
+            # At most history transitions are invalid, so listing the valid ones is rarely needed
+            valid_slots = np.flatnonzero(self.stack_index(np.arange(self.size))[2])
+            if valid_slots.size == 0:
+                raise RuntimeError(f'No valid transitions to sample among the {self.size} stored')
+            index[~valid] = valid_slots[self.rng.randint(valid_slots.size, size=np.count_nonzero(~valid))]
+        return self.gather(index)
+
+    def gather(self, index):
+        """
+        :param index: (B,) slots of valid transitions
+        :return: Batch
+        """
+        state, next_state, _ = self.stack_index(index)
+        return Batch(
+            state=self.select('frame', state),
+            action=self.select('action', index),
+            next_state=self.select('frame', next_state),
+            reward=self.select('reward', index),
+            done=self.select('done', index).float(),
+        )
+
+    def select(self, key, slots):
+        """
+        :param slots: (B, ...) slots
+        :return: (B, ..., *value shape) tensor on the device
+        """
+        value = self.storage[key]
+        slots = torch.from_numpy(slots)
+        # Gathered straight into pinned memory, so the copy to the gpu is asynchronous
+        out = torch.empty((slots.numel(), *value.shape[1:]), dtype=value.dtype,
+                          pin_memory=self.device.type == 'cuda')
+        torch.index_select(value, 0, slots.view(-1), out=out)
+        return out.view(*slots.shape, *value.shape[1:]).to(self.device, non_blocking=True)
+
+    def __len__(self):
+        return self.size
+
+    def save(self, path):
+        """
+        Write the stored transitions to an .npz file
+        """
+        if self.storage is None:
+            return
+        arrays = {key: value[:self.size].numpy() for key, value in self.storage.items()}
+        arrays['position'] = np.array(self.position % self.size)
+        arrays['history'] = np.array(self.history)
+        atomic_save(arrays, path, save_fn=lambda obj, f: np.savez(f, **obj))
+
+    def load(self, path):
+        """
+        Read transitions written by save. If there are more than capacity, the newest are kept.
+        """
+        with np.load(path) as data:
+            size = len(data['action'])
+            # Oldest first
+            order = (np.arange(size) + int(data['position'])) % size
+            order = order[max(size - self.capacity, 0):]
+            self.allocate((int(data['history']), *data['frame'].shape[1:]))
+            for key, value in self.storage.items():
+                value[:len(order)] = torch.from_numpy(data[key][order])
+        self.size = len(order)
+        self.position = self.size % self.capacity
+
+
+class SumTree:
+    """
+    Binary tree of sums over capacity priorities, to sample proportionally to them. Updates and
+    sampling are batched and O(log capacity) per element.
+    """
+
+    def __init__(self, capacity):
+        self.num_leaves = 1 << int(np.ceil(np.log2(max(capacity, 1))))
+        # Node i has children 2i and 2i + 1, the root is 1 and leaf j is num_leaves + j
+        self.tree = np.zeros(2 * self.num_leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, index):
+        """
+        :param index: (B,) leaves
+        :return: (B,) priorities
+        """
+        return self.tree[np.asarray(index) + self.num_leaves]
+
+    def update(self, index, priority):
+        """
+        :param index: (B,) leaves. If one is repeated, its last priority is kept
+        :param priority: (B,) or a scalar
+        """
+        node = np.asarray(index, dtype=np.int64) + self.num_leaves
+        if node.size == 0:
+            return
+        self.tree[node] = priority
+        # All nodes are at the same depth, up to the root
+        node = np.unique(node // 2)
+        while node[0] > 0:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node = np.unique(node // 2)
+
+    def find(self, values):
+        """
+        :param values: (B,) in [0, total)
+        :return: (B,) leaves whose cumulative priority interval contains the values
+        """
+        node = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.num_leaves.bit_length() - 1):
+            left = 2 * node
+            right = values >= self.tree[left]
+            values = np.where(right, values - self.tree[left], values)
+            node = np.where(right, left + 1, left)
+        return node - self.num_leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    Proportional prioritized replay (Schaul et al., 2016). Transitions are sampled with probability
+    p^alpha / sum(p^alpha), with p = |TD error| + eps set by update_priorities. New transitions get the
+    highest priority so far and invalid ones priority 0.
+
+    Batches come with importance sampling weights (N * P)^-beta, normalized by their maximum. beta is
+    annealed to 1 over beta_steps batches.
+    """
+
+    def __init__(self, capacity, device='cpu', seed=None, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        super().__init__(capacity, device, seed)
+        self.alpha = alpha
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.num_batches = 0
+
+    @property
+    def beta(self):
+        return min(1.0, self.beta_start + (1.0 - self.beta_start) * self.num_batches / self.beta_steps)
+
+    def push(self, state, action, next_state, reward, done):
+        i = self.position
+        super().push(state, action, next_state, reward, done)
+        self.tree.update([i], 0.0)
+        # The new transition, the previous newest one and the oldest ones can change validity
+        oldest = (self.position - self.size) % self.capacity
+        slots = np.array([i, i - 1, *range(oldest, oldest + self.history - 1)]) % self.capacity
+        self.refresh_priorities(np.unique(slots[slots < self.size]))
+
+    def refresh_priorities(self, slots):
+        """
+        Priority 0 for the invalid transitions among slots, the highest priority for valid ones without
+        a priority yet
+        """
+        valid = self.stack_index(slots)[2]
+        priority = self.tree.get(slots)
+        priority = np.where(priority > 0, priority, self.max_priority ** self.alpha)
+        self.tree.update(slots, np.where(valid, priority, 0.0))
+
+    def sample(self, batch_size):
+        """
+        Proportional sample, one transition per equal segment of the total priority
+
+        :return: Batch, with index and weight
+        """
+        total = self.tree.total()
+        if not total > 0:
+            raise RuntimeError(f'No valid transitions to sample among the {self.size} stored')
+        values = (np.arange(batch_size) + self.rng.random_sample(batch_size)) * (total / batch_size)
+        index = self.tree.find(np.minimum(values, np.nextafter(total, 0)))
+        priority = self.tree.get(index)
+        redraw = priority <= 0
+        if redraw.any():
+            # Rounding can land on a leaf with priority 0. Those are drawn again from the leaves with a
+            # priority, with the same probabilities
+            slots = np.arange(self.size)
+            candidates = self.tree.get(slots)
+            slots, candidates = slots[candidates > 0], candidates[candidates > 0]
+            index[redraw] = self.rng.choice(slots, size=np.count_nonzero(redraw),
+                                            p=candidates / candidates.sum())
+            priority = self.tree.get(index)
+        weight = (self.size * priority / total) ** -self.beta
+        weight = torch.from_numpy(weight / weight.max()).float().to(self.device)
+        self.num_batches += 1
+        return self.gather(index)._replace(index=index, weight=weight)
+
+    def update_priorities(self, index, td_error):
+        """
+        :param index: (B,) slots of a sampled batch
+        :param td_error: (B,) array
+        """
+        priority = np.abs(td_error) + self.eps
+        self.max_priority = max(self.max_priority, float(priority.max()))
+        # Transitions that became invalid since they were sampled keep priority 0
+        valid = self.tree.get(index) > 0
+        self.tree.update(index[valid], priority[valid] ** self.alpha)
+
+    def load(self, path):
+        """
+        Read transitions written by save. All valid transitions get the highest priority.
+        """
+        super().load(path)
+        self.tree = SumTree(self.capacity)
+        slots = np.arange(self.size)
+        self.refresh_priorities(slots)
@@ -7,6 +7,8 @@ PATH_TO_OUTPUTS = os.getcwd() + "/dqn/checkpoints/"
 print(PATH_TO_OUTPUTS)
 
 model_name = lambda training_name : PATH_TO_OUTPUTS + training_name + "_model.pth"
+# the replay memory is written next to the model, see ReplayMemory.save
+memory_name = lambda training_name : PATH_TO_OUTPUTS + training_name + "_memory.npz"
 
 def save_models(training_name, policy_model, target_model, optimizer, memory, episode, global_step, total_max_q, total_loss):
     if not os.path.exists(PATH_TO_OUTPUTS):
@@ -17,12 +19,12 @@ def save_models(training_name, policy_model, target_model, optimizer, memory, ep
             'policy_model_state_dict': policy_model.state_dict(),
             'target_model_state_dict': target_model.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
-            'memory': memory,
             'episode': episode,
             'global_step': global_step,
             'total_max_q': total_max_q,
             'total_loss': total_loss
             }, model_path)
+    memory.save(memory_name(training_name))
 
 
 # chec# checks if model with given name exists,
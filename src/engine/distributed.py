@@ -0,0 +1,61 @@
+import os
+import torch
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def launch(fn, cfg):
+    """
+    Run fn(cfg) in every process of a DistributedDataParallel job. Under torchrun, this process is one of
+    them. Otherwise we spawn cfg.world_size local processes.
+    """
+    if 'RANK' in os.environ:
+        setup(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), int(os.environ.get('LOCAL_RANK', 0)), cfg)
+        try:
+            fn(cfg)
+        finally:
+            dist.destroy_process_group()
+    else:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        mp.spawn(spawned_worker, args=(fn, cfg), nprocs=cfg.world_size)
+
+
+def spawned_worker(local_rank, fn, cfg):
+    # Spawned processes start from the default configs
+    from model.space.arch import arch
+    from eval.eval_cfg import eval_cfg
+    arch.merge_from_other_cfg(cfg.arch)
+    eval_cfg.merge_from_other_cfg(cfg.eval_cfg)
+
+    setup(local_rank, cfg.world_size, local_rank, cfg)
+    try:
+        fn(cfg)
+    finally:
+        dist.destroy_process_group()
+
+
+def setup(rank, world_size, local_rank, cfg):
+    assert not cfg.parallel, 'Use either "parallel" or "distributed"'
+    dist.init_process_group(cfg.dist_backend, rank=rank, world_size=world_size)
+    # One device per process
+    if 'cuda' in cfg.device:
+        cfg.device = f'cuda:{local_rank}'
+        torch.cuda.set_device(local_rank)
+    # Different noise on each rank. Weights are broadcast from rank 0 anyway
+    torch.manual_seed(cfg.seed + rank)
+    np.random.seed(cfg.seed + rank)
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
@@ -1,4 +1,4 @@
-from model import get_model
+from model import get_model, setup_bg_cache
 from eval import get_evaluator
 from dataset import get_dataset, get_dataloader
 from utils import Checkpointer
@@ -38,6 +38,7 @@ def eval(cfg):
         checkpoint = checkpointer.load_last('', model, None, None, use_cpu)
     elif cfg.eval.checkpoint == 'best':
         checkpoint = checkpointer.load_best(cfg.eval.metric, model, None, None, use_cpu)
+    setup_bg_cache(model, cfg)
     if cfg.parallel:
         assert 'cpu' not in cfg.device
         model = nn.DataParallel(model, device_ids=cfg.device_ids)
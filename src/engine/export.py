@@ -0,0 +1,31 @@
+from model import get_model
+from utils import Checkpointer, export_artifact, ARTIFACT_EXT
+import os.path as osp
+
+
+def export(cfg):
+    """
+    Write a weights-only inference artifact next to a checkpoint. Checkpointer.load picks it up when
+    no optimizers are loaded.
+    """
+    assert cfg.resume, 'You must pass "resume True" if --task is "export"'
+    assert cfg.eval.checkpoint in ['best', 'last']
+    
+    print('Experiment name:', cfg.exp_name)
+    print('Model name:', cfg.model)
+    print('Checkpoint:', cfg.resume_ckpt if cfg.resume_ckpt else f'{cfg.eval.checkpoint} checkpoint')
+    
+    model = get_model(cfg)
+    checkpointer = Checkpointer(osp.join(cfg.checkpointdir, cfg.exp_name), max_num=cfg.train.max_ckpt)
+    
+    if cfg.resume_ckpt:
+        path = cfg.resume_ckpt
+    elif cfg.eval.checkpoint == 'last':
+        path = checkpointer.last_checkpoint()
+        assert path, 'No checkpoint found'
+    else:
+        path = osp.join(checkpointer.checkpointdir, f'best_{cfg.eval.metric}.pth')
+    # Always from the full checkpoint, not from an earlier artifact
+    checkpoint = checkpointer.load(path, model, None, None, use_cpu=True, use_artifact=False)
+    
+    export_artifact(osp.splitext(path)[0] + ARTIFACT_EXT, model, checkpoint['epoch'], checkpoint['global_step'])
@@ -1,4 +1,4 @@
-from model import get_model
+from model import get_model, setup_bg_cache
 from vis import get_vislogger
 from dataset import get_dataset, get_dataloader
 from utils import Checkpointer
@@ -37,6 +37,7 @@ def show(cfg):
         # Load last checkpoint
         checkpoint = checkpointer.load_last('', model, None, None, use_cpu=use_cpu)
 
+    setup_bg_cache(model, cfg)
     if cfg.parallel:
         assert 'cpu' not in cfg.device, 'You can not set "parallel" to True when you set "device" to cpu'
         model = nn.DataParallel(model, device_ids=cfg.device_ids)
@@ -1,13 +1,19 @@
 from model import get_model
-from eval import get_evaluator
-from dataset import get_dataset, get_dataloader
+from model.space.arch import arch
+from eval import get_evaluator, AsyncEvaluator
+from dataset import get_dataset, get_dataloader, preprocess_batch, preprocess_flags
 from solver import get_optimizers
-from utils import Checkpointer, MetricLogger
+from utils import Checkpointer, MetricLogger, unwrap_model
+from .distributed import launch, is_main_process, barrier
 import os
 import os.path as osp
+import torch
 from torch import nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
-from vis import get_vislogger
+from vis import get_vislogger, AsyncVis
 import time
 from torch.nn.utils import clip_grad_norm_
 from tqdm import tqdm
@@ -15,6 +21,12 @@ from rtpt import RTPT
 
 
 def train(cfg):
+    if cfg.distributed and not dist.is_initialized():
+        # Runs train in every process
+        launch(train, cfg)
+        return
+    # Only the main process checkpoints, logs and evaluates
+    is_main = is_main_process()
 
     print('Experiment name:', cfg.exp_name)
     print('Dataset:', cfg.dataset)
@@ -31,7 +43,8 @@ def train(cfg):
     print('Loading data')
 
     trainloader = get_dataloader(cfg, 'train')
-    if cfg.train.eval_on:
+    preprocess = preprocess_flags(trainloader.dataset)
+    if is_main and cfg.train.eval_on and not cfg.train.eval_async:
         valset = get_dataset(cfg, 'val')
         # valloader = get_dataloader(cfg, 'val')
         evaluator = get_evaluator(cfg)
@@ -49,9 +62,16 @@ def train(cfg):
     else:
         print("Can't train")
         exit(1)
-    checkpointer = Checkpointer(osp.join(cfg.checkpointdir, suffix, cfg.exp_name), max_num=cfg.train.max_ckpt)
+    # The main process creates the checkpoint directory and list first
+    if not is_main:
+        barrier()
+    checkpointer = Checkpointer(osp.join(cfg.checkpointdir, suffix, cfg.exp_name), max_num=cfg.train.max_ckpt,
+                                async_save=cfg.train.async_save)
+    if is_main:
+        barrier()
     model.train()
 
+    # From the unwrapped model, so that both optimizers see the same parameters on every rank
     optimizer_fg, optimizer_bg = get_optimizers(cfg, model)
 
     start_epoch = 0
@@ -64,9 +84,20 @@ def train(cfg):
             global_step = checkpoint['global_step'] + 1
     if cfg.parallel:
         model = nn.DataParallel(model, device_ids=cfg.device_ids)
-
-    writer = SummaryWriter(log_dir=os.path.join(cfg.logdir, cfg.exp_name + str(cfg.seed)), flush_secs=30, purge_step=global_step)
+    if cfg.distributed:
+        # Gradients are averaged over ranks, so clipping and both optimizers step identically everywhere.
+        # Only with one background component are some parameters unused (the mask prior rnn). Looking for
+        # them costs a graph traversal every step, so it is only done then
+        model = DistributedDataParallel(model, device_ids=[torch.device(cfg.device)] if 'cuda' in cfg.device else None,
+                                        find_unused_parameters=arch.K == 1)
+
+    log_dir = os.path.join(cfg.logdir, cfg.exp_name + str(cfg.seed))
+    writer = SummaryWriter(log_dir=log_dir, flush_secs=30, purge_step=global_step) if is_main else None
+    if is_main and cfg.train.eval_on and cfg.train.eval_async:
+        evaluator = AsyncEvaluator(cfg, log_dir, checkpointer.checkpointdir)
     vis_logger = get_vislogger(cfg)
+    if is_main and cfg.train.vis_async:
+        vis_logger = AsyncVis(vis_logger, writer, max_queue=cfg.train.vis_queue_size)
     metric_logger = MetricLogger()
 
     print('Start training')
@@ -74,71 +105,91 @@ def train(cfg):
     rtpt = RTPT(name_initials='DV', experiment_name=cfg.exp_name,
                 max_iterations=cfg.train.max_epochs)
     rtpt.start()
-    for epoch in range(start_epoch, cfg.train.max_epochs):
-        if end_flag:
-            break
-
-        start = time.perf_counter()
-        with tqdm(total=len(trainloader)) as pbar:
-            for i, data in tqdm(enumerate(trainloader)):
-
-                end = time.perf_counter()
-                data_time = end - start
-                start = end
-
-                model.train()
-                imgs = data
-                imgs = imgs.to(cfg.device)
-                loss, log = model(imgs, global_step)
-                # In case of using DataParallel
-                loss = loss.mean()
-                optimizer_fg.zero_grad()
-                optimizer_bg.zero_grad()
-                loss.backward()
-                if cfg.train.clip_norm:
-                    clip_grad_norm_(model.parameters(), cfg.train.clip_norm)
-
-                optimizer_fg.step()
-
-                # if cfg.train.stop_bg == -1 or global_step < cfg.train.stop_bg:
-                optimizer_bg.step()
-
-                end = time.perf_counter()
-                batch_time = end - start
-
-                metric_logger.update(data_time=data_time)
-                metric_logger.update(batch_time=batch_time)
-                metric_logger.update(loss=loss.item())
-
-                if (global_step) % cfg.train.print_every == 0:
-                    start = time.perf_counter()
-                    log.update({
-                        'loss': metric_logger['loss'].median,
-                    })
-                    vis_logger.train_vis(writer, log, global_step, 'train')
-                    end = time.perf_counter()
+    # The workers are stopped even if training fails, or the evaluation process keeps the job alive
+    try:
+        for epoch in range(start_epoch, cfg.train.max_epochs):
+            if end_flag:
+                break
+
+            if isinstance(trainloader.sampler, DistributedSampler):
+                trainloader.sampler.set_epoch(epoch)
+            start = time.perf_counter()
+            with tqdm(total=len(trainloader), disable=not is_main) as pbar:
+                for i, data in tqdm(enumerate(trainloader), disable=not is_main):
 
-                    print(
-                        'exp: {}, epoch: {}, iter: {}/{}, global_step: {}, loss: {:.2f}, batch time: {:.4f}s, data time: {:.4f}s, log time: {:.4f}s'.format(
-                            cfg.exp_name, epoch + 1, i + 1, len(trainloader), global_step, metric_logger['loss'].median,
-                            metric_logger['batch_time'].avg, metric_logger['data_time'].avg, end - start))
+                    end = time.perf_counter()
+                    data_time = end - start
+                    start = end
+
+                    model.train()
+                    imgs = preprocess_batch(data, cfg.device, **preprocess)
+                    # Visualization is the only use of the log
+                    log_level = 'full' if is_main and global_step % cfg.train.print_every == 0 else 'none'
+                    loss, log = model(imgs, global_step, log_level=log_level)
+                    # In case of using DataParallel
+                    loss = loss.mean()
+                    optimizer_fg.zero_grad()
+                    optimizer_bg.zero_grad()
+                    loss.backward()
+                    if cfg.train.clip_norm:
+                        clip_grad_norm_(model.parameters(), cfg.train.clip_norm)
+
+                    optimizer_fg.step()
+
+                    # if cfg.train.stop_bg == -1 or global_step < cfg.train.stop_bg:
+                    optimizer_bg.step()
 
-                if (global_step) % cfg.train.save_every == 0:
-                    start = time.perf_counter()
-                    checkpointer.save_last(model, optimizer_fg, optimizer_bg, epoch, global_step)
-                    print('Saving checkpoint takes {:.4f}s.'.format(time.perf_counter() - start))
+                    end = time.perf_counter()
+                    batch_time = end - start
+
+                    metric_logger.update(data_time=data_time)
+                    metric_logger.update(batch_time=batch_time)
+                    metric_logger.update(loss=loss.item())
+
+                    if is_main and (global_step) % cfg.train.print_every == 0:
+                        start = time.perf_counter()
+                        log.update({
+                            'loss': metric_logger['loss'].median,
+                        })
+                        if cfg.train.vis_async:
+                            vis_logger.submit(log, global_step, 'train')
+                        else:
+                            vis_logger.train_vis(writer, log, global_step, 'train')
+                        end = time.perf_counter()
+
+                        print(
+                            'exp: {}, epoch: {}, iter: {}/{}, global_step: {}, loss: {:.2f}, batch time: {:.4f}s, data time: {:.4f}s, log time: {:.4f}s'.format(
+                                cfg.exp_name, epoch + 1, i + 1, len(trainloader), global_step, metric_logger['loss'].median,
+                                metric_logger['batch_time'].avg, metric_logger['data_time'].avg, end - start))
+
+                    if is_main and (global_step) % cfg.train.save_every == 0:
+                        start = time.perf_counter()
+                        checkpointer.save_last(model, optimizer_fg, optimizer_bg, epoch, global_step)
+                        print('Saving checkpoint takes {:.4f}s.'.format(time.perf_counter() - start))
+
+                    if not is_main or not cfg.train.eval_on or (global_step) % cfg.train.eval_every != 0:
+                        pass
+                    elif cfg.train.eval_async:
+                        evaluator.submit(model, epoch, global_step)
+                    else:
+                        print('Validating...')
+                        start = time.perf_counter()
+                        # Evaluate the unwrapped model, the other ranks don't take part
+                        model_eval = unwrap_model(model) if cfg.distributed else model
+                        checkpoint = [model, optimizer_fg, optimizer_bg, epoch, global_step]
+                        evaluator.train_eval(model_eval, valset, valset.bb_path, writer, global_step, cfg.device, checkpoint, checkpointer)
+                        print('Validation takes {:.4f}s.'.format(time.perf_counter() - start))
 
-                if (global_step) % cfg.train.eval_every == 0 and cfg.train.eval_on:
-                    print('Validating...')
                     start = time.perf_counter()
-                    checkpoint = [model, optimizer_fg, optimizer_bg, epoch, global_step]
-                    evaluator.train_eval(model, valset, valset.bb_path, writer, global_step, cfg.device, checkpoint, checkpointer)
-                    print('Validation takes {:.4f}s.'.format(time.perf_counter() - start))
-
-                start = time.perf_counter()
-                global_step += 1
-                pbar.update(1)
-                if global_step > cfg.train.max_steps:
-                    end_flag = True
-                    break
-        rtpt.step()
+                    global_step += 1
+                    pbar.update(1)
+                    if global_step > cfg.train.max_steps:
+                        end_flag = True
+                        break
+            rtpt.step()
+    finally:
+        checkpointer.wait()
+        if is_main and cfg.train.vis_async:
+            vis_logger.close()
+        if is_main and cfg.train.eval_on and cfg.train.eval_async:
+            evaluator.close()
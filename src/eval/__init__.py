@@ -1,6 +1,7 @@
-__all__ = ['get_evaluator']
+__all__ = ['get_evaluator', 'AsyncEvaluator']
 
 from .space_eval import SpaceEval
+from .async_eval import AsyncEvaluator
 
 def get_evaluator(cfg):
     if cfg.model == 'SPACE':
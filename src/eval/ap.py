@@ -70,6 +70,15 @@ def convert_to_boxes(z_where, z_pres, z_pres_prob, with_conf=False):
 
     return boxes
 
+# Parsed boxes of a bb directory are cached in a binary file next to it. Layout: int64 header
+# (version, directory mtime in ns, number of files, number of boxes), int64 offsets of each image's boxes,
+# then float32 (num_boxes, 4) boxes [y_min, y_max, x_min, x_max], in pixels
+BOX_CACHE_VERSION = 1
+BOX_CACHE_HEADER = 4
+# In-process memo, (path, size) -> boxes. The ground truth doesn't change during training
+_boxes_memo = {}
+
+
 def read_boxes(path, size):
     """
     Read bounding boxes and normalize to (0, 1)
@@ -77,12 +86,43 @@ def read_boxes(path, size):
     :param size: image width
     :return: A list of list [[y_min, y_max, x_min, x_max] * N] * B
     """
-    from glob import glob
-    filenames = glob(os.path.join(path, 'bb_*.txt'))
+    memo_key = (os.path.abspath(path), size)
+    if memo_key in _boxes_memo:
+        return _boxes_memo[memo_key]
 
+    from glob import glob
+    count = len(glob(os.path.join(path, 'bb_*.txt')))
+    mtime = os.stat(path).st_mtime_ns
+    cache_path = box_cache_path(path)
+
+    cached = load_box_cache(cache_path, mtime, count)
+    if cached is None:
+        cached = parse_boxes(path, count)
+        try:
+            save_box_cache(cache_path, mtime, count, *cached)
+        except OSError:
+            # Read-only dataset, parse again next time
+            pass
+    offsets, boxes = cached
+
+    boxes = np.asarray(boxes, dtype=np.float64) / size
     boxes_all = []
-    for i in range(len(filenames)):
-        boxes = []
+    for i in range(count):
+        # Images without boxes keep their old (0,) shape
+        boxes_all.append(boxes[offsets[i]:offsets[i + 1]] if offsets[i + 1] > offsets[i] else np.array([]))
+    _boxes_memo[memo_key] = boxes_all
+    return boxes_all
+
+
+def parse_boxes(path, count):
+    """
+    Parse bb_0.txt ... bb_{count-1}.txt
+
+    :return: offsets (count + 1,), boxes (num_boxes, 4) in pixels
+    """
+    boxes = []
+    offsets = [0]
+    for i in range(count):
         filename = os.path.join(path, 'bb_{}.txt'.format(i))
         with open(filename, 'r') as f:
             for line in f:
@@ -94,9 +134,44 @@ def read_boxes(path, size):
                     x_max = center_x + width / 2.0
 
                     boxes.append([y_min, y_max, x_min, x_max])
-        boxes = np.array(boxes) / size
-        boxes_all.append(boxes)
-    return boxes_all
+        offsets.append(len(boxes))
+    return np.array(offsets, dtype=np.int64), np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+def box_cache_path(path):
+    # Next to the directory, so that writing it doesn't change the directory mtime
+    return os.path.normpath(path) + '_cache.bin'
+
+
+def save_box_cache(cache_path, mtime, count, offsets, boxes):
+    header = np.array([BOX_CACHE_VERSION, mtime, count, len(boxes)], dtype=np.int64)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(offsets.astype(np.int64).tobytes())
+        f.write(boxes.astype(np.float32).tobytes())
+    os.replace(tmp_path, cache_path)
+
+
+def load_box_cache(cache_path, mtime, count):
+    """
+    :return: offsets, boxes (memory mapped), or None if there is no valid cache
+    """
+    if not os.path.exists(cache_path):
+        return None
+    header = np.fromfile(cache_path, dtype=np.int64, count=BOX_CACHE_HEADER)
+    if len(header) < BOX_CACHE_HEADER or list(header[:3]) != [BOX_CACHE_VERSION, mtime, count]:
+        return None
+    num_boxes = int(header[3])
+    offset = header.nbytes
+    offsets = np.fromfile(cache_path, dtype=np.int64, count=count + 1, offset=offset)
+    offset += offsets.nbytes
+    if len(offsets) != count + 1 or os.path.getsize(cache_path) != offset + num_boxes * 4 * 4:
+        return None
+    if num_boxes == 0:
+        return offsets, np.zeros((0, 4), dtype=np.float32)
+    boxes = np.memmap(cache_path, dtype=np.float32, mode='r', offset=offset, shape=(num_boxes, 4))
+    return offsets, boxes
 
 
 def compute_ap(pred_boxes, gt_boxes, iou_thresholds=None, recall_values=None):
@@ -117,83 +192,73 @@ def compute_ap(pred_boxes, gt_boxes, iou_thresholds=None, recall_values=None):
         iou_thresholds = np.linspace(0.5, 0.95, 10)
         # iou_thresholds = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
 
-    AP = []
-    for threshold in iou_thresholds:
-        # Compute AP for this threshold
-        # Number of total ground truths
-        count_gt = 0
-        hit = []
-        # For each image, determine each prediction is a hit of not
-        for pred, gt in zip(pred_boxes, gt_boxes):
-            count_gt += len(gt)
-            # Sort predictions within an image by descreasing confidence
-            pred = sorted(pred, key=lambda x: -x[-1])
-
-            if len(gt) == 0:
-                hit.extend((False, conf) for *_, conf in pred)
-                continue
-            if len(pred) == 0:
-                continue
-
-            M, N = len(pred), len(gt)
-
-            # (M, 4), (M) (N, 4)
-            pred = np.array(pred)
-            pred, conf = pred[:, :4], pred[:, -1]
-            gt = np.array(gt)
-
-            # (M, N)
-            iou = compute_iou(pred, gt)
-            # (M,)
-            best_indices = np.argmax(iou, axis=1)
-            # (M,)
-            best_iou = iou[np.arange(M), best_indices]
-            # (N,), thresholding results
-            valid = best_iou > threshold
-            used = [False] * N
-
-            for i in range(M):
-                # Only count first hit
-                if valid[i] and not used[best_indices[i]]:
-                    hit.append((True, conf[i]))
-                    used[best_indices[i]] = True
-                else:
-                    hit.append((False, conf[i]))
-
-        if len(hit) == 0:
-            AP.append(0.0)
+    # For each prediction: IoU with the ground truth it overlaps most, and the highest such IoU among
+    # predictions of the same image that have higher confidence and the same best ground truth.
+    # At any threshold a prediction is a hit iff the first exceeds the threshold and the second doesn't,
+    # since only the first valid prediction for a ground truth counts.
+    best_ious = []
+    prev_ious = []
+    confs = []
+    # Number of total ground truths
+    count_gt = 0
+    for pred, gt in zip(pred_boxes, gt_boxes):
+        count_gt += len(gt)
+        if len(pred) == 0:
+            continue
+        # Sort predictions within an image by descreasing confidence
+        pred = np.array(pred)
+        pred = pred[np.argsort(-pred[:, -1], kind='stable')]
+        # (M, 4), (M)
+        pred, conf = pred[:, :4], pred[:, -1]
+        M = len(pred)
+        confs.append(conf)
+        if len(gt) == 0:
+            # Never a hit
+            best_ious.append(np.full(M, -np.inf))
+            prev_ious.append(np.full(M, -np.inf))
             continue
 
-        # Sort
-        # hit.sort(key=lambda x: -x[-1])
-        hit = sorted(hit, key=lambda x: -x[-1])
-
-        # print('yes')
-        # print(hit)
-        hit = [x[0] for x in hit]
-        # print(hit)
-        # Compute average precision
-        # hit_cum = np.cumsum(np.array(hit, dtype=np.float32))
-        hit_cum = np.cumsum(hit)
-        num_cum = np.arange(len(hit)) + 1.0
-        precision = hit_cum / num_cum
-        recall = hit_cum / count_gt
-
-        # Compute AP at selected recall values
-        # print(precision)
-        precs = []
-        for val in recall_values:
-            prec = precision[recall >= val]
-            precs.append(0.0 if prec.size == 0 else prec.max())
-
-        # Mean over recall values
-        AP.append(np.mean(precs))
-        # AP.extend(precs)
-
-        # print(AP)
-
-    # mean over all thresholds
-    return AP
+        # (M, N)
+        iou = compute_iou(pred, np.array(gt))
+        # (M,)
+        best_indices = np.argmax(iou, axis=1)
+        # (M,)
+        best_iou = iou[np.arange(M), best_indices]
+        # (M, M), earlier predictions with the same best ground truth
+        same = (best_indices[:, None] == best_indices[None, :]) & np.tri(M, k=-1, dtype=bool)
+        best_ious.append(best_iou)
+        prev_ious.append(np.where(same, best_iou[None, :], -np.inf).max(axis=1))
+
+    T = len(iou_thresholds)
+    if len(confs) == 0 or count_gt == 0:
+        return [0.0] * T
+
+    # Sort all predictions by decreasing confidence
+    conf = np.concatenate(confs)
+    order = np.argsort(-conf, kind='stable')
+    best_iou = np.concatenate(best_ious)[order]
+    prev_iou = np.concatenate(prev_ious)[order]
+
+    # (T, 1)
+    thresholds = np.asarray(iou_thresholds)[:, None]
+    # (T, P), for all thresholds at once
+    hit = (best_iou > thresholds) & ~(prev_iou > thresholds)
+    hit_cum = np.cumsum(hit, axis=1)
+    num_cum = np.arange(hit.shape[1]) + 1.0
+    precision = hit_cum / num_cum
+    recall = hit_cum / count_gt
+
+    # Compute AP at selected recall values. Recall never decreases, so the precisions at recall >= val
+    # are a suffix and we need suffix maxima
+    # (T, P + 1), padded with the precision of empty suffixes
+    suffix_max = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]
+    suffix_max = np.concatenate([suffix_max, np.zeros((T, 1))], axis=1)
+    # (T, R), start of the suffix with recall >= val
+    start = np.stack([np.searchsorted(r, recall_values, side='left') for r in recall])
+    precs = suffix_max[np.arange(T)[:, None], start]
+
+    # Mean over recall values
+    return list(precs.mean(axis=1))
 
 
 def compute_iou(pred, gt):
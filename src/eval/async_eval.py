@@ -0,0 +1,100 @@
+import time
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+from torch.utils.tensorboard import SummaryWriter
+from utils import unwrap_model
+
+
+class AsyncEvaluator:
+    """
+    Runs the in-training evaluation in a separate process, so that training doesn't stop for it.
+
+    The worker builds its own model and validation set. submit hands it a cpu copy of the weights. It logs
+    to the same log directory and saves the best checkpoints, without optimizer states, to the same
+    checkpoint directory. If the worker is still busy with an earlier snapshot, the new one is skipped.
+    """
+
+    def __init__(self, cfg, log_dir, checkpointdir):
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=1)
+        # Not a daemon, since the evaluation uses DataLoader workers
+        self.process = ctx.Process(target=eval_worker, args=(cfg, log_dir, checkpointdir, self.queue))
+        self.process.start()
+
+    def submit(self, model, epoch, global_step):
+        """
+        :return: whether the snapshot was queued
+        """
+        if not self.process.is_alive():
+            print(f'Evaluator has stopped, skipping validation of step {global_step}.')
+            return False
+        model = unwrap_model(model)
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        try:
+            self.queue.put_nowait((state_dict, epoch, global_step))
+        except queue.Full:
+            print(f'Evaluator is busy, skipping validation of step {global_step}.')
+            return False
+        return True
+
+    def close(self, timeout=600):
+        """
+        Wait for the queued evaluations and stop the worker. If it doesn't stop within timeout seconds,
+        it is terminated.
+        """
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self.process.join(timeout)
+            if self.process.is_alive():
+                print('Evaluator did not stop, terminating it.')
+                self.process.terminate()
+                self.process.join()
+        self.process = None
+
+
+def eval_worker(cfg, log_dir, checkpointdir, jobs):
+    # Spawned processes start from the default configs
+    from model.space.arch import arch
+    from eval.eval_cfg import eval_cfg
+    arch.merge_from_other_cfg(cfg.arch)
+    eval_cfg.merge_from_other_cfg(cfg.eval_cfg)
+    torch.manual_seed(cfg.seed)
+
+    from model import get_model
+    from dataset import get_dataset
+    from eval import get_evaluator
+    from utils import Checkpointer
+
+    model = get_model(cfg).to(cfg.device)
+    valset = get_dataset(cfg, 'val')
+    evaluator = get_evaluator(cfg)
+    checkpointer = Checkpointer(checkpointdir, max_num=cfg.train.max_ckpt)
+    writer = SummaryWriter(log_dir=log_dir, flush_secs=30)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        state_dict, epoch, global_step = job
+        # A failed evaluation must not stop the worker, or close waits for it until the timeout
+        try:
+            model.load_state_dict(state_dict)
+            del state_dict
+
+            start = time.perf_counter()
+            checkpoint = [model, None, None, epoch, global_step]
+            evaluator.train_eval(model, valset, valset.bb_path, writer, global_step, cfg.device, checkpoint,
+                                 checkpointer)
+            print('Validation of step {} takes {:.4f}s.'.format(global_step, time.perf_counter() - start))
+        except Exception:
+            print(f'Validation of step {global_step} failed:')
+            traceback.print_exc()
+
+    writer.close()
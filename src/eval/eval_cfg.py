@@ -13,6 +13,8 @@ eval_cfg = CfgNode({
         # For dataloader
         'batch_size': 12,
         'num_workers': 4,
+        # Load the validation samples once and keep them on the device between evaluations
+        'preload': False,
     },
     'test': {
         # For dataloader
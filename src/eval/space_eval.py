@@ -1,6 +1,7 @@
-from utils import MetricLogger
+from utils import MetricLogger, unwrap_model
 import numpy as np
 import torch
+from torch import nn
 import math
 import os, sys
 from datetime import datetime
@@ -10,12 +11,14 @@ from tqdm import tqdm
 import json
 from .eval_cfg import eval_cfg
 from .ap import read_boxes, convert_to_boxes, compute_ap, compute_counts
+from dataset import preprocess_batch, preprocess_flags
 from torch.utils.tensorboard import SummaryWriter
 
 
 class SpaceEval():
     def __init__(self):
-        pass
+        # Preprocessed validation images kept as uint8 between evaluations. See cached_images
+        self.image_cache = None
 
     @torch.no_grad()
     def test_eval(self, model, testset, bb_path, device, evaldir, info):
@@ -44,10 +47,14 @@ class SpaceEval():
             - ap and accuracy evaluated on validation set
         :return:
         """
-        if 'mse' in eval_cfg.train.metrics:
+        if 'mse' in eval_cfg.train.metrics and 'ap' in eval_cfg.train.metrics:
+            # One pass over the validation set for both
+            results = self.train_eval_fused(model, valset, bb_path, writer, global_step, device)
+        elif 'mse' in eval_cfg.train.metrics:
             self.train_eval_mse(model, valset, writer, global_step, device)
-        if 'ap' in eval_cfg.train.metrics:
+        elif 'ap' in eval_cfg.train.metrics:
             results = self.train_eval_ap_and_acc(model, valset, bb_path, writer, global_step, device)
+        if 'ap' in eval_cfg.train.metrics:
             checkpointer.save_best('ap_dot5', results['APs'][0], checkpoint, min_is_better=False)
             checkpointer.save_best('ap_avg', np.mean(results['APs']), checkpoint, min_is_better=False)
             checkpointer.save_best('error_rate', results['error_rate'], checkpoint, min_is_better=True)
@@ -61,8 +68,31 @@ class SpaceEval():
         """
         result_dict = self.eval_ap_and_acc(
             model, valset, bb_path, eval_cfg.train.batch_size, eval_cfg.train.num_workers,
-            device, num_samples=eval_cfg.train.num_samples.ap
+            device, num_samples=eval_cfg.train.num_samples.ap, cache=eval_cfg.train.preload
         )
+        self.write_ap_and_acc(writer, result_dict, global_step)
+        
+        return result_dict
+    
+    @torch.no_grad()
+    def train_eval_fused(self, model, valset, bb_path, writer: SummaryWriter, global_step, device):
+        """
+        Evaluate mse, ap and accuracy during training with a single pass over the validation set
+        
+        :return: result_dict
+        """
+        result_dict = self.eval_mse_ap_and_acc(
+            model, valset, bb_path, eval_cfg.train.batch_size, eval_cfg.train.num_workers, device,
+            num_samples_mse=eval_cfg.train.num_samples.mse, num_samples_ap=eval_cfg.train.num_samples.ap,
+            global_step=global_step, cache=eval_cfg.train.preload
+        )
+        writer.add_scalar(f'val/mse', result_dict['mse'], global_step=global_step)
+        writer.add_scalar(f'val/loss', result_dict['loss'], global_step=global_step)
+        self.write_ap_and_acc(writer, result_dict, global_step)
+        
+        return result_dict
+    
+    def write_ap_and_acc(self, writer: SummaryWriter, result_dict, global_step):
         APs = result_dict['APs']
         iou_thresholds = result_dict['iou_thresholds']
         accuracy = result_dict['accuracy']
@@ -79,8 +109,6 @@ class SpaceEval():
         writer.add_scalar('val/overcount', overcount, global_step)
         writer.add_scalar('val/undercount', undercount, global_step)
         writer.add_scalar('val/error_rate', error_rate, global_step)
-        
-        return result_dict
 
     @torch.no_grad()
     def train_eval_mse(self, model, valset, writer, global_step, device):
@@ -92,16 +120,14 @@ class SpaceEval():
         num_workers = eval_cfg.train.num_workers
         
         model.eval()
-        valset = Subset(valset, indices=range(num_samples))
-        dataloader = DataLoader(valset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+        batches = self.batches(valset, num_samples, batch_size, num_workers, device, cache=eval_cfg.train.preload)
     
         metric_logger = MetricLogger()
     
         print(f'Evaluating MSE using {num_samples} samples.')
         with tqdm(total=num_samples) as pbar:
-            for batch_idx, sample in enumerate(dataloader):
-                imgs = sample.to(device)
-                loss, log = model(imgs, global_step)
+            for imgs in batches:
+                loss, log = model(imgs, global_step, log_level='scalars')
                 B = imgs.size(0)
                 for b in range(B):
                     metric_logger.update(
@@ -130,6 +156,7 @@ class SpaceEval():
             device,
             num_samples=None,
             iou_thresholds=None,
+            cache=False,
     ):
         """
         Evaluate average precision and accuracy
@@ -143,6 +170,7 @@ class SpaceEval():
         :param output_path: checkpointdir to output result json file
         :param num_samples: number of samples for evaluating it. If None use all samples
         :param iou_thresholds:
+        :param cache: keep the preprocessed images between calls, see cached_images
         :return ap: a list of average precisions, corresponding to each iou_thresholds
         """
         
@@ -153,8 +181,7 @@ class SpaceEval():
         
         if num_samples is None:
             num_samples = len(dataset)
-        dataset = Subset(dataset, indices=range(num_samples))
-        dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+        batches = self.batches(dataset, num_samples, batch_size, num_workers, device, cache)
         
         if iou_thresholds is None:
             iou_thresholds = np.linspace(0.5, 0.95, 10)
@@ -162,39 +189,154 @@ class SpaceEval():
     
         boxes_pred = []
         model.eval()
+        # Only the foreground latents are needed
+        encoder = unwrap_model(model)
         with torch.no_grad():
             print('Computing boxes...')
-            pbar = tqdm(total=len(dataloader))
-            for i, imgs in enumerate(dataloader):
-                imgs = imgs.to(device)
-            
-                # TODO: treat global_step in a more elegant way
-                loss, log = \
-                    model(imgs, global_step=100000000)
+            pbar = tqdm(total=math.ceil(num_samples / batch_size))
+            for imgs in batches:
             
-                # (B, N, 4), (B, N, 1), (B, N, 1)
-                z_where, z_pres_prob = log['z_where'], log['z_pres_prob']
-                # (B, N, 4), (B, N), (B, N)
-                z_where = z_where.detach().cpu()
-                z_pres_prob = z_pres_prob.detach().cpu().squeeze()
-                # TODO: look at this
-                z_pres = z_pres_prob > 0.5
+                latents = encoder.encode(imgs)
             
-                boxes_batch = convert_to_boxes(z_where, z_pres, z_pres_prob)
-                boxes_pred.extend(boxes_batch)
+                # (B, N, 4), (B, N, 1)
+                boxes_pred.extend(self.latents_to_boxes(latents['z_where'], latents['z_pres_prob']))
                 pbar.update(1)
         
-            print('Computing error rates and counts...')
-            # Four numbers
-            error_rate, perfect, overcount, undercount = compute_counts(boxes_pred, boxes_gt)
-            accuracy = perfect / (perfect + overcount + undercount)
+            result_dict = self.ap_and_acc(boxes_pred, boxes_gt, iou_thresholds)
+    
+        model.train()
         
-            print('Computing average precision...')
-            # A list of length 10
-            APs = compute_ap(boxes_pred, boxes_gt, iou_thresholds)
+        return result_dict
     
+    def eval_mse_ap_and_acc(
+            self,
+            model,
+            dataset,
+            bb_path,
+            batch_size,
+            num_workers,
+            device,
+            num_samples_mse,
+            num_samples_ap,
+            global_step,
+            iou_thresholds=None,
+            cache=False,
+    ):
+        """
+        Evaluate mse, loss, average precision and accuracy with one forward pass per image. Boxes are from
+        the posterior mean of z_where, as in eval_ap_and_acc.
+        
+        :param num_samples_mse: number of samples for mse and loss
+        :param num_samples_ap: number of samples for average precision and accuracy
+        :param cache: keep the preprocessed images between calls, see cached_images
+        :return: the result_dict of eval_ap_and_acc, plus mse and loss
+        """
+        model.eval()
+        
+        num_samples = max(num_samples_mse, num_samples_ap)
+        batches = self.batches(dataset, num_samples, batch_size, num_workers, device, cache)
+        
+        if iou_thresholds is None:
+            iou_thresholds = np.linspace(0.5, 0.95, 10)
+        boxes_gt = read_boxes(bb_path, 128)[:num_samples_ap]
+        
+        metric_logger = MetricLogger()
+        boxes_pred = []
+        
+        print(f'Evaluating MSE using {num_samples_mse} samples and AP using {num_samples_ap} samples.')
+        start = 0
+        with tqdm(total=num_samples) as pbar:
+            for imgs in batches:
+                loss, log = model(imgs, global_step, log_level='scalars')
+                B = imgs.size(0)
+                
+                # Images start, ..., start + B - 1 of the subset
+                num_mse = min(max(num_samples_mse - start, 0), B)
+                if num_mse > 0:
+                    for mse in log['mse'][:num_mse].tolist():
+                        metric_logger.update(mse=mse)
+                    metric_logger.update(loss=loss.mean())
+                num_ap = min(max(num_samples_ap - start, 0), B)
+                if num_ap > 0:
+                    boxes_pred.extend(self.latents_to_boxes(log['z_where_mean'][:num_ap], log['z_pres_prob'][:num_ap]))
+                
+                start += B
+                pbar.update(B)
+        
+        result_dict = self.ap_and_acc(boxes_pred, boxes_gt, iou_thresholds)
+        result_dict['mse'] = metric_logger['mse'].global_avg
+        result_dict['loss'] = metric_logger['loss'].global_avg
+        
         model.train()
         
+        return result_dict
+    
+    def batches(self, dataset, num_samples, batch_size, num_workers, device, cache=False):
+        """
+        Preprocessed batches of the first num_samples images of a dataset
+        
+        :param cache: stream from the images kept by cached_images instead of loading them
+        :return: a generator of (B, 3, H, W) float batches on device
+        """
+        if cache:
+            imgs = self.cached_images(dataset, num_samples, batch_size, num_workers, device)
+            for start in range(0, num_samples, batch_size):
+                yield imgs[start:start + batch_size].to(device, non_blocking=True).float() / 255
+            return
+        
+        flags = preprocess_flags(dataset)
+        dataset = Subset(dataset, indices=range(num_samples))
+        dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+        for imgs in dataloader:
+            yield preprocess_batch(imgs, device, **flags)
+    
+    def cached_images(self, dataset, num_samples, batch_size, num_workers, device):
+        """
+        The first num_samples images of a dataset, preprocessed. They are loaded once and kept as uint8 on
+        device, or in pinned memory if device is the cpu. The ground truth boxes are kept by read_boxes.
+        
+        :return: (num_samples, 3, H, W) uint8
+        """
+        cache = self.image_cache
+        if cache is None or cache['dataset'] is not dataset or cache['device'] != str(device) \
+                or len(cache['imgs']) < num_samples:
+            print(f'Caching {num_samples} validation images.')
+            # Preprocessed images are multiples of 1 / 255, so this is lossless
+            imgs = torch.cat([
+                (batch * 255).round().to(torch.uint8)
+                for batch in self.batches(dataset, num_samples, batch_size, num_workers, device)
+            ])
+            if imgs.device.type == 'cpu' and torch.cuda.is_available():
+                imgs = imgs.pin_memory()
+            cache = self.image_cache = {'dataset': dataset, 'device': str(device), 'imgs': imgs}
+        return cache['imgs'][:num_samples]
+    
+    @staticmethod
+    def latents_to_boxes(z_where, z_pres_prob):
+        """
+        :param z_where: (B, N, 4)
+        :param z_pres_prob: (B, N, 1)
+        :return: [[y_min, y_max, x_min, x_max] * N] * B
+        """
+        # (B, N, 4), (B, N), (B, N)
+        z_where = z_where.detach().cpu()
+        z_pres_prob = z_pres_prob.detach().cpu().squeeze(-1)
+        # TODO: look at this
+        z_pres = z_pres_prob > 0.5
+        
+        return convert_to_boxes(z_where, z_pres, z_pres_prob)
+    
+    @staticmethod
+    def ap_and_acc(boxes_pred, boxes_gt, iou_thresholds):
+        print('Computing error rates and counts...')
+        # Four numbers
+        error_rate, perfect, overcount, undercount = compute_counts(boxes_pred, boxes_gt)
+        accuracy = perfect / (perfect + overcount + undercount)
+        
+        print('Computing average precision...')
+        # A list of length 10
+        APs = compute_ap(boxes_pred, boxes_gt, iou_thresholds)
+        
         return {
             'APs': APs,
             'iou_thresholds': iou_thresholds,
@@ -2,6 +2,7 @@ from engine.utils import get_config
 from engine.train import train
 from engine.eval import eval
 from engine.show import show
+from engine.export import export
 
 
 if __name__ == '__main__':
@@ -10,6 +11,7 @@ if __name__ == '__main__':
         'train': train,
         'eval': eval,
         'show': show,
+        'export': export,
     }
     cfg, task = get_config()
     assert task in task_dict
@@ -1,6 +1,7 @@
 from .space.space import Space
+from .space.arch import arch
 
-__all__ = ['get_model']
+__all__ = ['get_model', 'setup_bg_cache']
 
 def get_model(cfg):
     """
@@ -14,3 +15,14 @@ def get_model(cfg):
         model = Space()
         
     return model
+
+
+def setup_bg_cache(model, cfg):
+    """
+    Enable the background cache if arch.bg_cache is set. Only for inference with fixed weights, never
+    during training
+    """
+    if cfg.model == 'SPACE' and arch.bg_cache:
+        # Backgrounds of different games never share an entry
+        game = cfg.gamelist[0] if len(cfg.gamelist) == 1 else None
+        model.enable_bg_cache(game, arch.bg_cache_mb)
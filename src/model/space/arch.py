@@ -51,6 +51,14 @@ arch = CfgNode({
     # Fix alpha for the first N steps
     'fix_alpha_steps': 0,
     'fix_alpha_value': 0.1,
+    
+    # Sparse inference. In eval mode, only cells with z_pres_prob above the threshold are encoded,
+    # decoded and composited. All other cells are treated as empty (z_pres = 0)
+    'sparse_inference': False,
+    'sparse_z_pres_threshold': 0.5,
+    # Run the foreground and background modules in two threads in the forward pass, only on cpu. The
+    # backward pass is run by autograd as usual. Samples are the same as when running them in sequence
+    'concurrent_branches': False,
     # ==== END ====
     
     
@@ -72,5 +80,11 @@ arch = CfgNode({
     'rnn_mask_prior_hidden_dim': 64,
     # Hidden layer dim for the network that computes q(z_c|z_m, x)
     'predict_comp_hidden_dim': 64,
+    # Reuse the background components of earlier frames in eval mode, keyed by game and a frame
+    # signature. See BgCache. Only for games whose background barely changes. Used by the eval and show
+    # tasks, never during training
+    'bg_cache': False,
+    # Memory limit of the cache
+    'bg_cache_mb': 256,
     # ==== END ====
 })
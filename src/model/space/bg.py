@@ -1,10 +1,12 @@
 import torch
+from collections import OrderedDict
 from torch import nn
 from attrdict import AttrDict
 from torch.nn import functional as F
 from torch.distributions.normal import Normal
 from torch.distributions.kl import kl_divergence
 from .arch import arch
+from .utils import rsample
 
 
 class SpaceBg(nn.Module):
@@ -34,7 +36,8 @@ class SpaceBg(nn.Module):
             self.comp_decoder = CompDecoderStrong()
 
         # ==== Prior related ====
-        self.rnn_mask_prior = nn.LSTMCell(arch.z_mask_dim, arch.rnn_mask_prior_hidden_dim)
+        # Unlike rnn_mask, this only conditions on posterior samples, so it runs over the whole sequence at once
+        self.rnn_mask_prior = nn.LSTM(arch.z_mask_dim, arch.rnn_mask_prior_hidden_dim, batch_first=True)
         # Initial h and c
         self.rnn_mask_h_prior = nn.Parameter(torch.zeros(arch.rnn_mask_prior_hidden_dim))
         self.rnn_mask_c_prior = nn.Parameter(torch.zeros(arch.rnn_mask_prior_hidden_dim))
@@ -45,10 +48,24 @@ class SpaceBg(nn.Module):
         # ==== Prior related ====
 
         self.bg_sigma = arch.bg_sigma
+        
+        # For loading old checkpoints, where rnn_mask_prior was an LSTMCell
+        self._register_load_state_dict_pre_hook(self.rename_rnn_mask_prior)
     
     def anneal(self, global_step):
         pass
     
+    @staticmethod
+    def rename_rnn_mask_prior(state_dict, prefix, *args):
+        """
+        LSTMCell parameters (weight_ih, ...) -> single layer LSTM parameters (weight_ih_l0, ...).
+        The layouts are the same.
+        """
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            key = prefix + 'rnn_mask_prior.' + name
+            if key in state_dict:
+                state_dict[key + '_l0'] = state_dict.pop(key)
+    
     def forward(self, x, global_step):
         """
         Background inference backward pass
@@ -66,12 +83,10 @@ class SpaceBg(nn.Module):
         # (B, D)
         x_enc = self.image_enc(x)
         
-        # Mask and component latents over the K slots
-        masks = []
+        # Mask latents over the K slots. Each step conditions on the previous sample, so this is a loop
         z_masks = []
-        # These two are Normal instances
-        z_mask_posteriors = []
-        z_comp_posteriors = []
+        z_mask_locs = []
+        z_mask_scales = []
         
         # Initialization: encode x and dummy z_mask_0
         z_mask = self.z_mask_0.expand(B, arch.z_mask_dim)
@@ -85,16 +100,19 @@ class SpaceBg(nn.Module):
             
             # Predict next mask from x and z_{mask, 1:k-1}
             z_mask_loc, z_mask_scale = self.predict_mask(h)
-            z_mask_post = Normal(z_mask_loc, z_mask_scale)
-            z_mask = z_mask_post.rsample()
+            z_mask = rsample(Normal(z_mask_loc, z_mask_scale))
             z_masks.append(z_mask)
-            z_mask_posteriors.append(z_mask_post)
-            # Decode masks
-            mask = self.mask_decoder(z_mask)
-            masks.append(mask)
+            z_mask_locs.append(z_mask_loc)
+            z_mask_scales.append(z_mask_scale)
+        
+        # (B, K, D)
+        z_masks = torch.stack(z_masks, dim=1)
+        z_mask_post = Normal(torch.stack(z_mask_locs, dim=1), torch.stack(z_mask_scales, dim=1))
         
+        # Decode all masks in one go, (B*K, D) -> (B*K, 1, H, W)
+        masks = self.mask_decoder(z_masks.view(B * arch.K, arch.z_mask_dim))
         # (B, K, 1, H, W), in range (0, 1)
-        masks = torch.stack(masks, dim=1)
+        masks = masks.view(B, arch.K, *masks.size()[1:])
         
         # SBP to ensure they sum to 1
         masks = self.SBP(masks)
@@ -106,20 +124,14 @@ class SpaceBg(nn.Module):
         # Reshape (B, K, 1, H, W) -> (B*K, 1, H, W)
         masks = masks.view(B * K, 1, H, W)
         
-        # Concatenate images (B*K, 4, H, W)
-        comp_vae_input = torch.cat(((masks + 1e-5).log(), x[:, None].repeat(1, K, 1, 1, 1).view(B * K, 3, H, W)), dim=1)
-        
-        # Component latents, each (B*K, L)
-        z_comp_loc, z_comp_scale = self.comp_encoder(comp_vae_input)
-        z_comp_post = Normal(z_comp_loc, z_comp_scale)
-        z_comp = z_comp_post.rsample()
+        # Component latents, each (B*K, L). The image part of the first convolution is only computed once per
+        # image instead of concatenating K copies of the image to the masks
+        z_comp_loc, z_comp_scale = self.comp_encoder((masks + 1e-5).log(), img=x)
+        z_comp = rsample(Normal(z_comp_loc, z_comp_scale))
         
         # Record component posteriors here. We will use this for computing KL
-        z_comp_loc_reshape = z_comp_loc.view(B, K, -1)
-        z_comp_scale_reshape = z_comp_scale.view(B, K, -1)
-        for i in range(arch.K):
-            z_comp_post_this = Normal(z_comp_loc_reshape[:, i], z_comp_scale_reshape[:, i])
-            z_comp_posteriors.append(z_comp_post_this)
+        # (B, K, L)
+        z_comp_post = Normal(z_comp_loc.view(B, K, -1), z_comp_scale.view(B, K, -1))
         
         # Decode into component images, (B*K, 3, H, W)
         comps = self.comp_decoder(z_comp)
@@ -129,44 +141,31 @@ class SpaceBg(nn.Module):
         masks = masks.view(B, K, 1, H, W)
         
         # Now we are ready to compute the background likelihoods
-        # (B, K, 3, H, W)
-        comp_dist = Normal(comps, torch.full_like(comps, self.bg_sigma))
-        log_likelihoods = comp_dist.log_prob(x[:, None].expand_as(comps))
-        
-        # (B, K, 3, H, W) -> (B, 3, H, W), mixture likelihood
-        log_sum = log_likelihoods + (masks + 1e-5).log()
-        bg_likelihood = torch.logsumexp(log_sum, dim=1)
-
-        # Background reconstruction
-        bg = (comps * masks).sum(dim=1)
+        bg_likelihood, bg = self.likelihood(x, comps, masks)
         
         # Below we compute priors and kls
         
-        # Conditional KLs
-        z_mask_total_kl = 0.0
-        z_comp_total_kl = 0.0
-        
-        # Initial h and c. This is h_1 and c_1 in the paper
-        h = self.rnn_mask_h_prior.expand(B, arch.rnn_mask_prior_hidden_dim)
-        c = self.rnn_mask_c_prior.expand(B, arch.rnn_mask_prior_hidden_dim)
-        
-        for i in range(arch.K):
-            # Compute prior distribution over z_masks
-            z_mask_loc_prior, z_mask_scale_prior = self.predict_mask_prior(h)
-            z_mask_prior = Normal(z_mask_loc_prior, z_mask_scale_prior)
-            # Compute component prior, using posterior samples
-            z_comp_loc_prior, z_comp_scale_prior = self.predict_comp_prior(z_masks[i])
-            z_comp_prior = Normal(z_comp_loc_prior, z_comp_scale_prior)
-            # Compute KLs as we go.
-            z_mask_kl = kl_divergence(z_mask_posteriors[i], z_mask_prior).sum(dim=1)
-            z_comp_kl = kl_divergence(z_comp_posteriors[i], z_comp_prior).sum(dim=1)
-            # (B,)
-            z_mask_total_kl += z_mask_kl
-            z_comp_total_kl += z_comp_kl
-            
-            # Compute next state. Note we condition we posterior samples.
-            # Again, this is conditional prior.
-            (h, c) = self.rnn_mask_prior(z_masks[i], (h, c))
+        # Initial h and c. This is h_1 and c_1 in the paper. (1, B, D)
+        h = self.rnn_mask_h_prior.expand(1, B, arch.rnn_mask_prior_hidden_dim).contiguous()
+        c = self.rnn_mask_c_prior.expand(1, B, arch.rnn_mask_prior_hidden_dim).contiguous()
+        # (B, K, D). Note we condition on posterior samples. Again, this is conditional prior.
+        # Since all samples are known, the whole recurrence is a single sequence op.
+        h_prior = h.transpose(0, 1)
+        if K > 1:
+            # (B, K-1, D), h_2 ... h_K
+            h_next, _ = self.rnn_mask_prior(z_masks[:, :-1], (h, c))
+            h_prior = torch.cat((h_prior, h_next), dim=1)
+        
+        # Compute prior distribution over z_masks, (B*K, D) -> (B, K, D)
+        z_mask_loc_prior, z_mask_scale_prior = self.predict_mask_prior(h_prior.reshape(B * K, -1))
+        z_mask_prior = Normal(z_mask_loc_prior.view(B, K, -1), z_mask_scale_prior.view(B, K, -1))
+        # Compute component prior, using posterior samples, (B*K, L) -> (B, K, L)
+        z_comp_loc_prior, z_comp_scale_prior = self.predict_comp_prior(z_masks.view(B * K, -1))
+        z_comp_prior = Normal(z_comp_loc_prior.view(B, K, -1), z_comp_scale_prior.view(B, K, -1))
+        
+        # Conditional KLs, (B, K, D) -> (B,)
+        z_mask_total_kl = kl_divergence(z_mask_post, z_mask_prior).flatten(start_dim=1).sum(1)
+        z_comp_total_kl = kl_divergence(z_comp_post, z_comp_prior).flatten(start_dim=1).sum(1)
             
         # For visualization
         kl_bg = z_mask_total_kl + z_comp_total_kl
@@ -182,6 +181,30 @@ class SpaceBg(nn.Module):
         
         return bg_likelihood, bg, kl_bg, log
 
+    def likelihood(self, x, comps, masks):
+        """
+        Background likelihood and reconstruction given components and masks
+        
+        :param x: (B, 3, H, W)
+        :param comps: (B, K, 3, H, W)
+        :param masks: (B, K, 1, H, W)
+        :return:
+            bg_likelihood: (B, 3, H, W)
+            bg: (B, 3, H, W)
+        """
+        # (B, K, 3, H, W)
+        comp_dist = Normal(comps, torch.full_like(comps, self.bg_sigma))
+        log_likelihoods = comp_dist.log_prob(x[:, None].expand_as(comps))
+        
+        # (B, K, 3, H, W) -> (B, 3, H, W), mixture likelihood
+        log_sum = log_likelihoods + (masks + 1e-5).log()
+        bg_likelihood = torch.logsumexp(log_sum, dim=1)
+        
+        # Background reconstruction
+        bg = (comps * masks).sum(dim=1)
+        
+        return bg_likelihood, bg
+
     @staticmethod
     def SBP(masks):
         """
@@ -209,6 +232,86 @@ class SpaceBg(nn.Module):
             
 
 
+class BgCache:
+    """
+    LRU cache of background components for inference on games with (mostly) static backgrounds.
+    
+    Frames are keyed by game and a cheap signature, the frame average pooled to signature_size cells and
+    quantized. An entry holds comps, masks and kl_bg of the first frame seen with that key, and is
+    recomputed after max_uses hits. Least recently used entries are evicted when the cache holds more
+    than max_mb of tensors.
+    
+    The signature has to tell frames apart: with a few cells and levels, say 4x4 and 16, nearly every frame
+    of a game maps to the same key. The cache only holds for fixed weights, Space clears it when it is
+    put in training mode or loads weights.
+    """
+    
+    def __init__(self, max_mb=256, signature_size=16, levels=32, max_uses=100):
+        self.max_bytes = max_mb * 2 ** 20
+        self.signature_size = signature_size
+        self.levels = levels
+        self.max_uses = max_uses
+        # Part of the key. Set this when switching games
+        self.game = None
+        self.entries = OrderedDict()
+        # Hits of each entry
+        self.uses = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def keys(self, x):
+        """
+        :param x: (B, 3, H, W), in range (0, 1)
+        :return: a list of B keys
+        """
+        # (B, 3, S, S)
+        signature = F.adaptive_avg_pool2d(x, self.signature_size)
+        signature = (signature * (self.levels - 1)).round().to(torch.uint8)
+        signature = signature.flatten(start_dim=1).cpu().numpy()
+        return [(self.game, s.tobytes()) for s in signature]
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.uses[key] >= self.max_uses:
+            # Too old, recompute
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.uses[key] += 1
+            self.entries.move_to_end(key)
+        return entry
+    
+    def put(self, key, entry):
+        """
+        :param entry: a dictionary of tensors
+        """
+        if key in self.entries:
+            return
+        self.entries[key] = entry
+        self.uses[key] = 0
+        self.nbytes += self.entry_bytes(entry)
+        # Keep at least the newest entry
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+    
+    def remove(self, key):
+        self.nbytes -= self.entry_bytes(self.entries.pop(key))
+        del self.uses[key]
+    
+    def clear(self):
+        self.entries.clear()
+        self.uses.clear()
+        self.nbytes = 0
+    
+    @staticmethod
+    def entry_bytes(entry):
+        return sum(t.numel() * t.element_size() for t in entry.values())
+
+
 class Flatten(nn.Module):
     def forward(self, x):
         return x.view(x.size(0), -1)
@@ -367,16 +470,30 @@ class CompEncoder(nn.Module):
             nn.Linear(64 * embed_size ** 2, arch.z_comp_dim * 2),
         )
     
-    def forward(self, x):
+    def forward(self, x, img=None):
         """
         Predict component latent parameters given image and predicted mask concatenated
         
-        :param x: (B, 3+1, H, W). Image and mask concatenated
+        :param x: (B, 3+1, H, W). Image and mask concatenated. If img is given, only the mask, (B*K, 1, H, W)
+        :param img: (B, 3, H, W). If given, the mask of each of the K slots is combined with this image.
+            Since the first convolution is linear, its image part is computed once per image and broadcast.
         :return:
             z_comp_loc: (B, D)
             z_comp_scale: (B, D)
         """
-        x = self.enc(x)
+        if img is None:
+            x = self.enc(x)
+        else:
+            B = img.size(0)
+            conv = self.enc[0]
+            # The input channels are (mask, r, g, b)
+            # (B*K, C, H', W')
+            x = F.conv2d(x, conv.weight[:, :1], conv.bias, conv.stride, conv.padding)
+            # (B, C, H', W')
+            img = F.conv2d(img, conv.weight[:, 1:], None, conv.stride, conv.padding)
+            # (B, K, C, H', W') -> (B*K, C, H', W')
+            x = (x.view(B, -1, *x.size()[1:]) + img[:, None]).flatten(end_dim=1)
+            x = self.enc[1:](x)
         z_comp_loc = x[:, :arch.z_comp_dim]
         z_comp_scale = F.softplus(x[:, arch.z_comp_dim:]) + 1e-4
         
@@ -1,10 +1,11 @@
 import sys
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Normal, kl_divergence
 from .utils import NumericalRelaxedBernoulli, kl_divergence_bern_bern, get_boundary_kernel_new, get_boundary_kernel
-from .utils import spatial_transform, linear_annealing
+from .utils import extract_glimpses, glimpse_windows, paste_windows, linear_annealing, rsample
 from .arch import arch
 
 
@@ -39,7 +40,8 @@ class SpaceFg(nn.Module):
         # self.register_buffer('prior_shift_mean_new', torch.tensor(0.))
         # self.register_buffer('prior_shift_std_new', torch.tensor(1.))
         
-        # TODO: These are placeholders for loading old checkpoints. No longer used
+        # TODO: These are placeholders for loading old checkpoints. No longer used. Inference artifacts
+        # don't store them, see legacy_keys
         self.boundary_filter = get_boundary_kernel(sigma=20)
         self.register_buffer('prior_scale_mean',
                              torch.tensor([arch.z_scale_mean_start_value] * 2).view((arch.z_where_scale_dim), 1, 1))
@@ -50,6 +52,10 @@ class SpaceFg(nn.Module):
         self.register_buffer('prior_shift_std',
                              torch.tensor([1., 1.]).view((arch.z_where_shift_dim), 1, 1))
     
+    # State dict keys of the placeholders above
+    legacy_keys = ['boundary_filter.weight',
+                   'prior_scale_mean', 'prior_scale_std', 'prior_shift_mean', 'prior_shift_std']
+    
     @property
     def z_what_prior(self):
         return Normal(self.prior_what_mean, self.prior_what_std)
@@ -84,12 +90,13 @@ class SpaceFg(nn.Module):
                                     arch.tau_start_step, arch.tau_end_step,
                                     arch.tau_start_value, arch.tau_end_value)
     
-    def forward(self, x, globel_step):
+    def forward(self, x, globel_step, log_level='full'):
         """
-        Forward pass
+        Forward pass. If arch.sparse_inference is set, only the present cells are decoded in eval mode.
 
         :param x: (B, 3, H, W)
         :param globel_step: global step (training)
+        :param log_level: unless 'full', things only needed for visualization are not computed. See Space.forward
         :return:
             fg_likelihood: (B, 3, H, W)
             y_nobg: (B, 3, H, W), foreground reconstruction
@@ -106,51 +113,79 @@ class SpaceFg(nn.Module):
         z_pres, z_depth, z_scale, z_shift, z_where, \
         z_pres_logits, z_depth_post, z_scale_post, z_shift_post = self.img_encoder(x, self.tau)
         
-        # (B, 3, H, W) -> (B*G*G, 3, H, W). Note we must use repeat_interleave instead of repeat
-        x_repeat = torch.repeat_interleave(x, arch.G ** 2, dim=0)
-        
-        # (B*G*G, 3, H, W), where G is the grid size
-        # Extract glimpse
-        x_att = spatial_transform(x_repeat, z_where.view(B * arch.G ** 2, 4),
-                                  (B * arch.G ** 2, 3, arch.glimpse_size, arch.glimpse_size), inverse=False)
-        
-        # (B*G*G, D)
+        # In sparse mode, z_pres is thresholded first and everything glimpse related is only computed for
+        # the M present cells. In dense mode, M = B*G*G
+        sparse = arch.sparse_inference and not self.training
+        if sparse:
+            # (B, G*G)
+            present = torch.sigmoid(z_pres_logits).view(B, arch.G ** 2) > arch.sparse_z_pres_threshold
+            # Cells below the threshold are treated as empty
+            z_pres = z_pres * present[..., None].float()
+            # (M,), (M,). Image and cell index of each present cell
+            batch_idx, cell_idx = present.nonzero(as_tuple=True)
+            # (M,). Present cells of an image go to slots 0, 1, ..., S-1
+            slot_idx = (present.long().cumsum(dim=1) - 1)[batch_idx, cell_idx]
+            S = max(int(present.sum(dim=1).max()), 1)
+            # (B, G*G, ...) -> (M, ...)
+            pack = lambda t: t[batch_idx, cell_idx]
+        else:
+            # (M,)
+            batch_idx = torch.arange(B, device=x.device).repeat_interleave(arch.G ** 2)
+            # (B, G*G, ...) -> (B*G*G, ...)
+            pack = lambda t: t.flatten(end_dim=1)
+        
+        # (M, 4)
+        z_where_pack = pack(z_where)
+        M = z_where_pack.size(0)
+        
+        # (M, 3, H, W), where H, W is the glimpse size
+        # Extract glimpse. All glimpses of an image are sampled from a single copy of it
+        if sparse:
+            # (M, 4) -> (B, S, 4). Unused slots sample a single pixel and are dropped again
+            z_where_slots = self.scatter(z_where_pack, batch_idx, slot_idx, B, S)
+            # (B, S, 3, H, W) -> (M, 3, H, W)
+            x_att = extract_glimpses(x, z_where_slots, arch.glimpse_size)[batch_idx, slot_idx]
+        else:
+            # (B, G*G, 3, H, W) -> (B*G*G, 3, H, W)
+            x_att = extract_glimpses(x, z_where, arch.glimpse_size).flatten(end_dim=1)
+        
+        # (M, D)
         z_what, z_what_post = self.z_what_net(x_att)
         
         # Decode z_what into small reconstructed glimpses
-        # All (B*G*G, 3, H, W)
+        # All (M, 3, H, W)
         o_att, alpha_att = self.glimpse_dec(z_what)
-        # z_pres: (B, G*G, 1) -> (B*G*G, 1, 1, 1)
-        alpha_att_hat = alpha_att * z_pres.view(-1, 1, 1, 1)
-        # (B*G*G, 3, H, W)
+        # z_pres: (B, G*G, 1) -> (M, 1, 1, 1)
+        alpha_att_hat = alpha_att * pack(z_pres).view(-1, 1, 1, 1)
+        # (M, 3, H, W)
         y_att = alpha_att_hat * o_att
         
         # Compute pixel-wise object weights
-        # (B*G*G, 1, H, W). These are glimpse size
-        importance_map = alpha_att_hat * 100.0 * torch.sigmoid(-z_depth.view(B*arch.G**2, 1, 1, 1))
-        # (B*G*G, 1, H, W). These are of full resolution
-        importance_map_full_res = spatial_transform(importance_map, z_where.view(B * arch.G ** 2, 4), (B*arch.G**2, 1, *arch.img_shape),
-                                                    inverse=True)
-        
-        # (B*G*G, 1, H, W) -> (B, G*G, 1, H, W)
-        importance_map_full_res = importance_map_full_res.view(B, arch.G ** 2, 1, *arch.img_shape)
-        # Normalize (B, >G*G<, 1, H, W)
-        importance_map_full_res_norm = torch.softmax(importance_map_full_res, dim=1)
-        
-        # To full resolution
-        # (B*G*G, 3, H, W) -> (B, G*G, 3, H, W)
-        y_each_cell = spatial_transform(y_att, z_where.view(B * arch.G ** 2, 4), (B * arch.G ** 2, 3, *arch.img_shape),
-                                        inverse=True).view(B, arch.G ** 2, 3, *arch.img_shape)
+        # (M, 1, H, W). These are glimpse size
+        importance_map = alpha_att_hat * 100.0 * torch.sigmoid(-pack(z_depth).view(M, 1, 1, 1))
+        
+        # To full resolution. We only rasterize each glimpse into the window it covers
+        # (M, h, w, 2), (M, h*w)
+        grid, pixel_idx = glimpse_windows(z_where_pack, arch.glimpse_size, arch.img_shape)
+        # (M, 3+1+1, h, w)
+        windows = F.grid_sample(torch.cat((y_att, alpha_att_hat, importance_map), dim=1), grid, align_corners=True)
+        y_win, alpha_win, importance_win = windows.split([3, 1, 1], dim=1)
+        
+        # Softmax over all G*G cells. Outside of its window, a cell has zero importance and adds exp(0) to the
+        # normalizer. Importance is in [0, 100], so we shift by 50 to keep everything in float32 range.
+        empty_weight = math.exp(-50.0)
+        # (M, 1, h, w)
+        weight_win = (importance_win - 50.0).exp()
+        # (B, 3+1+1, H, W)
+        weighted_sum = paste_windows(torch.cat((y_win * weight_win, alpha_win * weight_win,
+                                                weight_win - empty_weight), dim=1),
+                                     pixel_idx, batch_idx, B, arch.img_shape)
+        # (B, 1, H, W)
+        normalizer = weighted_sum[:, 4:] + arch.G ** 2 * empty_weight
         # Weighted sum, (B, 3, H, W)
-        y_nobg = (y_each_cell * importance_map_full_res_norm).sum(dim=1)
-        
-        # To full resolution
-        # (B*G*G, 1, H, W) -> (B, G*G, 1, H, W)
-        alpha_map = spatial_transform(alpha_att_hat, z_where.view(B * arch.G ** 2, 4), (B * arch.G ** 2, 1, *arch.img_shape),
-                                      inverse=True).view(B, arch.G ** 2, 1, *arch.img_shape)
-        
+        y_nobg = weighted_sum[:, :3] / normalizer
         # Weighted sum, (B, 1, H, W)
-        alpha_map = (alpha_map * importance_map_full_res_norm).sum(dim=1)
+        alpha_map = weighted_sum[:, 3:4] / normalizer
         
         # Everything is computed. Now let's compute loss
         # Compute KL divergences
@@ -164,14 +199,25 @@ class SpaceFg(nn.Module):
         kl_z_scale = kl_divergence(z_scale_post, self.z_scale_prior)
         kl_z_shift = kl_divergence(z_shift_post, self.z_shift_prior)
         
-        # Reshape z_what and z_what_post
-        # (B*G*G, D) -> (B, G*G, D)
-        z_what = z_what.view(B, arch.G ** 2, arch.z_what_dim)
-        z_what_post = Normal(*[x.view(B, arch.G ** 2, arch.z_what_dim)
-                               for x in [z_what_post.mean, z_what_post.stddev]])
-        # (B, G*G, D)
+        # (M, D)
         kl_z_what = kl_divergence(z_what_post, self.z_what_prior)
         
+        # Back to the usual layout
+        if sparse:
+            # Empty cells are never encoded. Their z_what is zero and they have no z_what kl.
+            # (M, D) -> (B, G*G, D)
+            z_what, kl_z_what = [self.scatter(x, batch_idx, cell_idx, B, arch.G ** 2) for x in [z_what, kl_z_what]]
+            # (M, C, H, W) -> (B*G*G, C, H, W)
+            if log_level == 'full':
+                o_att, alpha_att, alpha_att_hat = [
+                    self.scatter(x, batch_idx, cell_idx, B, arch.G ** 2).flatten(end_dim=1)
+                    for x in [o_att, alpha_att, alpha_att_hat]
+                ]
+        else:
+            # (B*G*G, D) -> (B, G*G, D)
+            z_what = z_what.view(B, arch.G ** 2, arch.z_what_dim)
+            kl_z_what = kl_z_what.view(B, arch.G ** 2, arch.z_what_dim)
+        
         # dimensionality check
         assert ((kl_z_pres.size() == (B, arch.G ** 2, 1)) and
                 (kl_z_depth.size() == (B, arch.G ** 2, 1)) and
@@ -187,29 +233,32 @@ class SpaceFg(nn.Module):
         # (B,)
         kl_z_where = kl_z_scale + kl_z_shift
         
-        # Compute boundary loss
-        # (1, 1, K, K)
-        boundary_kernel = self.boundary_kernel[None, None].to(x.device)
-        # (1, 1, K, K) * (B*G*G, 1, 1) -> (B*G*G, 1, K, K)
-        boundary_kernel = boundary_kernel * z_pres.view(B * arch.G ** 2, 1, 1, 1)
-        # (B, G*G, 1, H, W), to full resolution
-        boundary_map = spatial_transform(boundary_kernel, z_where.view(B * arch.G ** 2, 4), (B * arch.G ** 2, 1, *arch.img_shape),
-                                         inverse=True).view(B, arch.G ** 2, 1, *arch.img_shape)
-        # (B, 1, H, W)
-        boundary_map = boundary_map.sum(dim=1)
-        # TODO: some magic number. For reproducibility I will keep it
-        boundary_map = boundary_map * 1000
-        # (B, 1, H, W) * (B, 1, H, W)
-        overlap = boundary_map * alpha_map
-        # TODO: another magic number. For reproducibility I will keep it
-        p_boundary = Normal(0, 0.7)
-        # (B, 1, H, W)
-        boundary_loss = p_boundary.log_prob(overlap)
-        # (B,)
-        boundary_loss = boundary_loss.flatten(start_dim=1).sum(1)
-        
-        # NOTE: we want to minimize this
-        boundary_loss = -boundary_loss
+        # Compute boundary loss. Skipped if it is off and the boundary map isn't logged
+        use_boundary = arch.boundary_loss and globel_step <= arch.bl_off_step
+        if use_boundary or log_level == 'full':
+            # (1, 1, K, K)
+            boundary_kernel = self.boundary_kernel[None, None].to(x.device)
+            # (1, 1, K, K) * (M, 1, 1) -> (M, 1, K, K)
+            boundary_kernel = boundary_kernel * pack(z_pres).view(M, 1, 1, 1)
+            # (M, 1, h, w) -> (B, 1, H, W), to full resolution and summed over cells
+            boundary_map = paste_windows(F.grid_sample(boundary_kernel, grid, align_corners=True),
+                                         pixel_idx, batch_idx, B, arch.img_shape)
+            # TODO: some magic number. For reproducibility I will keep it
+            boundary_map = boundary_map * 1000
+            # (B, 1, H, W) * (B, 1, H, W)
+            overlap = boundary_map * alpha_map
+            # TODO: another magic number. For reproducibility I will keep it
+            p_boundary = Normal(0, 0.7)
+            # (B, 1, H, W)
+            boundary_loss = p_boundary.log_prob(overlap)
+            # (B,)
+            boundary_loss = boundary_loss.flatten(start_dim=1).sum(1)
+            
+            # NOTE: we want to minimize this
+            boundary_loss = -boundary_loss
+        else:
+            boundary_map = None
+            boundary_loss = x.new_zeros(B)
         
         # Compute foreground likelhood
         fg_dist = Normal(y_nobg, self.fg_sigma)
@@ -239,6 +288,8 @@ class SpaceFg(nn.Module):
             'z_shift': z_shift,
             'z_depth': z_depth,
             'z_pres_prob': torch.sigmoid(z_pres_logits),
+            # Posterior mean, for deterministic boxes in evaluation
+            'z_where_mean': self.img_encoder.to_where(z_scale_post.mean, z_shift_post.mean)[2].detach(),
             'prior_z_pres_prob': self.prior_z_pres_prob.unsqueeze(0),
             'o_att': o_att,
             'alpha_att_hat': alpha_att_hat,
@@ -246,7 +297,6 @@ class SpaceFg(nn.Module):
             'alpha_map': alpha_map,
             'boundary_loss': boundary_loss,
             'boundary_map': boundary_map,
-            'importance_map_full_res_norm': importance_map_full_res_norm,
             
             'kl_z_what': kl_z_what,
             'kl_z_pres': kl_z_pres,
@@ -256,6 +306,48 @@ class SpaceFg(nn.Module):
             'kl_z_where': kl_z_where,
         }
         return fg_likelihood, y_nobg, alpha_map, kl, boundary_loss, log
+    
+    def encode(self, x, deterministic=True):
+        """
+        Only infer the latents. Decoders, compositing and losses are skipped.
+
+        :param x: (B, 3, H, W)
+        :param deterministic: if True, use posterior means instead of samples
+        :return: a dictionary containing
+            z_where: (B, G*G, 4)
+            z_pres_prob: (B, G*G, 1)
+            z_what: (B, G*G, D)
+            z_depth: (B, G*G, 1)
+        """
+        z_pres, z_depth, z_scale, z_shift, z_where, \
+        z_pres_logits, z_depth_post, z_scale_post, z_shift_post = self.img_encoder(x, self.tau, deterministic)
+        
+        # (B, G*G, 3, H, W) -> (B*G*G, 3, H, W)
+        x_att = extract_glimpses(x, z_where, arch.glimpse_size).flatten(end_dim=1)
+        # (B*G*G, D) -> (B, G*G, D)
+        z_what, _ = self.z_what_net(x_att, deterministic)
+        z_what = z_what.view(x.size(0), arch.G ** 2, arch.z_what_dim)
+        
+        return {
+            'z_where': z_where,
+            'z_pres_prob': torch.sigmoid(z_pres_logits),
+            'z_what': z_what,
+            'z_depth': z_depth,
+        }
+    
+    @staticmethod
+    def scatter(x, batch_idx, idx, B, N):
+        """
+        Scatter packed values back into a batch layout
+
+        :param x: (M, ...)
+        :param batch_idx: (M,), image index of each value
+        :param idx: (M,), position of each value within its image
+        :return: (B, N, ...). Positions without a value are zero
+        """
+        out = x.new_zeros(B, N, *x.size()[1:])
+        out[batch_idx, idx] = x
+        return out
 
 
 class ImgEncoderFg(nn.Module):
@@ -328,12 +420,13 @@ class ImgEncoderFg(nn.Module):
         # (2, G, G). I do this just to ensure that device is correct.
         self.register_buffer('offset', torch.stack((offset_x, offset_y), dim=0).float())
     
-    def forward(self, x, tau):
+    def forward(self, x, tau, deterministic=False):
         """
         Given image, infer z_pres, z_depth, z_where
 
         :param x: (B, 3, H, W)
         :param tau: temperature for the relaxed bernoulli
+        :param deterministic: if True, use posterior means instead of samples. z_pres is then z_pres_prob
         :return
             z_pres: (B, G*G, 1)
             z_depth: (B, G*G, 1)
@@ -369,11 +462,14 @@ class ImgEncoderFg(nn.Module):
         z_pres_logits = 8.8 * torch.tanh(self.z_pres_net(cat_enc))
         # (B, 1, G, G) - > (B, G*G, 1)
         z_pres_logits = reshape(z_pres_logits)
-        z_pres_post = NumericalRelaxedBernoulli(logits=z_pres_logits, temperature=tau)
-        # Unbounded
-        z_pres_y = z_pres_post.rsample()
-        # in (0, 1)
-        z_pres = torch.sigmoid(z_pres_y)
+        if deterministic:
+            z_pres = torch.sigmoid(z_pres_logits)
+        else:
+            z_pres_post = NumericalRelaxedBernoulli(logits=z_pres_logits, temperature=tau)
+            # Unbounded
+            z_pres_y = rsample(z_pres_post)
+            # in (0, 1)
+            z_pres = torch.sigmoid(z_pres_y)
         
         # (B, 1, G, G)
         z_depth_mean, z_depth_std = self.z_depth_net(cat_enc).chunk(2, 1)
@@ -382,7 +478,7 @@ class ImgEncoderFg(nn.Module):
         z_depth_std = F.softplus(z_depth_std)
         z_depth_post = Normal(z_depth_mean, z_depth_std)
         # (B, G*G, 1)
-        z_depth = z_depth_post.rsample()
+        z_depth = z_depth_post.mean if deterministic else rsample(z_depth_post)
         
         # (B, 2, G, G)
         scale_std_bias = 1e-15
@@ -391,7 +487,7 @@ class ImgEncoderFg(nn.Module):
         # (B, 2, G, G) -> (B, G*G, 2)
         z_scale_mean, z_scale_std = reshape(z_scale_mean, z_scale_std)
         z_scale_post = Normal(z_scale_mean, z_scale_std)
-        z_scale = z_scale_post.rsample()
+        z_scale = z_scale_post.mean if deterministic else rsample(z_scale_post)
         
         # (B, 2, G, G)
         z_shift_mean, z_shift_std = self.z_shift_net(cat_enc).chunk(2, 1)
@@ -399,18 +495,9 @@ class ImgEncoderFg(nn.Module):
         # (B, 2, G, G) -> (B, G*G, 2)
         z_shift_mean, z_shift_std = reshape(z_shift_mean, z_shift_std)
         z_shift_post = Normal(z_shift_mean, z_shift_std)
-        z_shift = z_shift_post.rsample()
+        z_shift = z_shift_post.mean if deterministic else rsample(z_shift_post)
         
-        # scale: unbounded to (0, 1), (B, G*G, 2)
-        z_scale = z_scale.sigmoid()
-        # offset: (2, G, G) -> (G*G, 2)
-        offset = self.offset.permute(1, 2, 0).view(arch.G ** 2, 2)
-        # (B, G*G, 2) and (G*G, 2)
-        # where: (-1, 1)(local) -> add center points -> (0, 2) -> (-1, 1)
-        z_shift = (2.0 / arch.G) * (offset + 0.5 + z_shift.tanh()) - 1
-        
-        # (B, G*G, 4)
-        z_where = torch.cat((z_scale, z_shift), dim=-1)
+        z_scale, z_shift, z_where = self.to_where(z_scale, z_shift)
         
         # Check dimensions
         assert (
@@ -423,6 +510,29 @@ class ImgEncoderFg(nn.Module):
         
         return z_pres, z_depth, z_scale, z_shift, z_where, \
                z_pres_logits, z_depth_post, z_scale_post, z_shift_post
+    
+    def to_where(self, z_scale, z_shift):
+        """
+        Unbounded scale and local shift to image coordinates
+        
+        :param z_scale: (B, G*G, 2)
+        :param z_shift: (B, G*G, 2)
+        :return:
+            z_scale: (B, G*G, 2), in (0, 1)
+            z_shift: (B, G*G, 2), in (-1, 1)
+            z_where: (B, G*G, 4)
+        """
+        # scale: unbounded to (0, 1), (B, G*G, 2)
+        z_scale = z_scale.sigmoid()
+        # offset: (2, G, G) -> (G*G, 2)
+        offset = self.offset.permute(1, 2, 0).view(arch.G ** 2, 2)
+        # (B, G*G, 2) and (G*G, 2)
+        # where: (-1, 1)(local) -> add center points -> (0, 2) -> (-1, 1)
+        z_shift = (2.0 / arch.G) * (offset + 0.5 + z_shift.tanh()) - 1
+        
+        # (B, G*G, 4)
+        z_where = torch.cat((z_scale, z_shift), dim=-1)
+        return z_scale, z_shift, z_where
 
 
 class ZWhatEnc(nn.Module):
@@ -453,11 +563,12 @@ class ZWhatEnc(nn.Module):
         
         self.enc_what = nn.Linear(256, arch.z_what_dim * 2)
     
-    def forward(self, x):
+    def forward(self, x, deterministic=False):
         """
         Encode a (32, 32) glimpse into z_what
 
         :param x: (B, C, H, W)
+        :param deterministic: if True, z_what is the posterior mean
         :return:
             z_what: (B, D)
             z_what_post: (B, D)
@@ -468,7 +579,7 @@ class ZWhatEnc(nn.Module):
         z_what_mean, z_what_std = self.enc_what(x.flatten(start_dim=1)).chunk(2, -1)
         z_what_std = F.softplus(z_what_std)
         z_what_post = Normal(z_what_mean, z_what_std)
-        z_what = z_what_post.rsample()
+        z_what = z_what_mean if deterministic else rsample(z_what_post)
         
         return z_what, z_what_post
 
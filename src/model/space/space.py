@@ -4,7 +4,28 @@ import torch.nn.functional as F
 from attrdict import AttrDict
 from .arch import arch
 from .fg import SpaceFg
-from .bg import SpaceBg
+from .bg import SpaceBg, BgCache
+from .utils import run_concurrently
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads for arch.concurrent_branches, created on first use. Not an attribute of Space, so that
+# copying and pickling the model is not affected
+_branch_pool = None
+
+
+def get_branch_pool():
+    global _branch_pool
+    if _branch_pool is None:
+        _branch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='space-branch')
+    return _branch_pool
+
+
+# Entries of the log kept with log_level 'scalars'. Per image values and latents, no image sized tensors
+SCALAR_LOG_KEYS = [
+    'mse', 'log_like', 'boundary_loss', 'kl_bg',
+    'kl_z_what', 'kl_z_pres', 'kl_z_scale', 'kl_z_shift', 'kl_z_depth', 'kl_z_where',
+    'z_what', 'z_where', 'z_where_mean', 'z_pres', 'z_pres_prob', 'z_scale', 'z_shift', 'z_depth',
+]
 
 
 class Space(nn.Module):
@@ -14,24 +35,39 @@ class Space(nn.Module):
         
         self.fg_module = SpaceFg()
         self.bg_module = SpaceBg()
+        # Optional background cache for inference. See enable_bg_cache
+        self.bg_cache = None
         
-    def forward(self, x, global_step):
+    def forward(self, x, global_step, log_level='full'):
         """
         Inference.
         
         :param x: (B, 3, H, W)
         :param global_step: global training step
+        :param log_level: what goes into log. 'full' for visualization, 'scalars' for SCALAR_LOG_KEYS,
+            'none' for nothing. Below 'full', tensors only needed for visualization are not computed.
         :return:
             loss: a scalor. Note it will be better to return (B,)
             log: a dictionary for visualization
         """
+        assert log_level in ['none', 'scalars', 'full'], f'Unknown log level "{log_level}"'
         
         # Background extraction
         # (B, 3, H, W), (B, 3, H, W), (B,)
-        bg_likelihood, bg, kl_bg, log_bg = self.bg_module(x, global_step)
+        if self.bg_cache is not None and not self.training:
+            background = lambda: self.cached_bg(x, global_step)
+        else:
+            background = lambda: self.bg_module(x, global_step)
         
         # Foreground extraction
-        fg_likelihood, fg, alpha_map, kl_fg, loss_boundary, log_fg = self.fg_module(x, global_step)
+        foreground = lambda: self.fg_module(x, global_step, log_level)
+        
+        if arch.concurrent_branches and x.device.type == 'cpu':
+            (bg_likelihood, bg, kl_bg, log_bg), (fg_likelihood, fg, alpha_map, kl_fg, loss_boundary, log_fg) = \
+                run_concurrently(get_branch_pool(), [background, foreground])
+        else:
+            bg_likelihood, bg, kl_bg, log_bg = background()
+            fg_likelihood, fg, alpha_map, kl_fg, loss_boundary, log_fg = foreground()
 
         # Fix alpha trick
         if global_step and global_step < arch.fix_alpha_steps:
@@ -57,6 +93,9 @@ class Space(nn.Module):
         # Mean over batch
         loss = (-elbo + loss_boundary).mean()
         
+        if log_level == 'none':
+            return loss, {}
+        
         log = {
             'imgs': x,
             'y': y,
@@ -66,5 +105,95 @@ class Space(nn.Module):
         }
         log.update(log_fg)
         log.update(log_bg)
+        if log_level == 'scalars':
+            log = {key: log[key] for key in SCALAR_LOG_KEYS}
         
         return loss, log
+    
+    def inference_state_dict(self):
+        """
+        State dict without the placeholders kept for loading old checkpoints
+        """
+        legacy = {'fg_module.' + key for key in self.fg_module.legacy_keys}
+        return {k: v for k, v in self.state_dict().items() if k not in legacy}
+    
+    def load_inference_state_dict(self, state_dict):
+        """
+        Load a state dict written by inference_state_dict. The placeholders keep their initial values.
+        """
+        legacy = {'fg_module.' + key for key in self.fg_module.legacy_keys}
+        missing, unexpected = self.load_state_dict(state_dict, strict=False)
+        missing = [key for key in missing if key not in legacy]
+        if missing or unexpected:
+            raise RuntimeError(f'Error loading inference state dict. Missing keys: {missing}. '
+                               f'Unexpected keys: {unexpected}.')
+    
+    def train(self, mode=True):
+        # Cached backgrounds were computed with weights that training is about to change
+        if mode and self.bg_cache is not None:
+            self.bg_cache.clear()
+        return nn.Module.train(self, mode)
+    
+    def load_state_dict(self, state_dict, strict=True):
+        if self.bg_cache is not None:
+            self.bg_cache.clear()
+        return nn.Module.load_state_dict(self, state_dict, strict)
+    
+    def enable_bg_cache(self, game=None, max_mb=256):
+        """
+        Reuse background components of earlier frames with the same signature in eval mode. Only use
+        this for games whose background barely changes, and with fixed weights.
+        
+        :param game: name of the game, part of the cache key
+        :param max_mb: memory limit of the cache
+        """
+        self.bg_cache = BgCache(max_mb)
+        self.bg_cache.game = game
+    
+    def disable_bg_cache(self):
+        self.bg_cache = None
+    
+    def cached_bg(self, x, global_step):
+        """
+        Same as self.bg_module(x, global_step), but components and masks are looked up in the cache first.
+        Only the misses go through the background module. This is fine because it is in eval mode, so
+        the images of a batch are independent.
+        """
+        keys = self.bg_cache.keys(x)
+        entries = [self.bg_cache.get(key) for key in keys]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if missing:
+            _, _, kl_bg, log_bg = self.bg_module(x[missing], global_step)
+            for j, i in enumerate(missing):
+                # Clone so that an entry does not keep the whole batch alive
+                entry = {
+                    'comps': log_bg['comps'][j].detach().clone(),
+                    'masks': log_bg['masks'][j].detach().clone(),
+                    'kl_bg': kl_bg[j].detach().clone(),
+                }
+                self.bg_cache.put(keys[i], entry)
+                entries[i] = entry
+        
+        # (B, K, 3, H, W), (B, K, 1, H, W), (B,)
+        comps, masks, kl_bg = [torch.stack([entry[name] for entry in entries])
+                               for name in ['comps', 'masks', 'kl_bg']]
+        bg_likelihood, bg = self.bg_module.likelihood(x, comps, masks)
+        log_bg = {
+            'comps': comps,
+            'masks': masks,
+            'bg': bg,
+            'kl_bg': kl_bg
+        }
+        return bg_likelihood, bg, kl_bg, log_bg
+    
+    def encode(self, x, deterministic=True):
+        """
+        Foreground latents only. Use this instead of forward when only z_where, z_pres_prob and z_what
+        are needed. The background, the decoders and the losses are skipped.
+        
+        :param x: (B, 3, H, W)
+        :param deterministic: if True, use posterior means instead of samples
+        :return: a dictionary with z_where (B, N, 4), z_pres_prob (B, N, 1), z_what (B, N, D) and
+            z_depth (B, N, 1), where N = G*G
+        """
+        return self.fg_module.encode(x, deterministic)
@@ -1,8 +1,13 @@
+import threading
 import torch
 import torch.nn.functional as F
 from torch.distributions import RelaxedBernoulli
 from torch.distributions.utils import broadcast_all
 
+# Branch of run_concurrently that runs in the current thread, used by rsample. The global generator is
+# shared by all threads, so concurrent branches have to take turns drawing from it
+_branch_state = threading.local()
+
 
 def spatial_transform(image, z_where, out_dims, inverse=False):
     """ spatial transformer network used to scale and shift input according to z_where in:
@@ -30,6 +35,152 @@ def spatial_transform(image, z_where, out_dims, inverse=False):
     # 3. sample image from grid
     return F.grid_sample(image, grid, align_corners=True)
 
+
+def extract_glimpses(image, z_where, glimpse_size):
+    """
+    Extract all glimpses of an image with a single sampling grid per image, so the image is not repeated
+    once per glimpse. Same as spatial_transform(..., inverse=False) on repeated images, and differentiable
+    with respect to z_where.
+
+    :param image: (B, C, H, W)
+    :param z_where: (B, N, 4), [sx, sy, tx, ty]
+    :param glimpse_size: g
+    :return: (B, N, C, g, g)
+    """
+    B, C, H, W = image.size()
+    N = z_where.size(1)
+    g = glimpse_size
+    # (g,). Normalized glimpse coordinates, as in F.affine_grid with align_corners=True
+    base = torch.linspace(-1, 1, g, device=image.device, dtype=image.dtype)
+    # (B, N, g)
+    grid_x = z_where[..., 0:1] * base + z_where[..., 2:3]
+    grid_y = z_where[..., 1:2] * base + z_where[..., 3:4]
+    # (B, N, g, g, 2) -> (B, N*g, g, 2). Glimpses are stacked along the height
+    grid = torch.stack((grid_x[:, :, None, :].expand(B, N, g, g),
+                        grid_y[:, :, :, None].expand(B, N, g, g)), dim=-1)
+    grid = grid.view(B, N * g, g, 2)
+    # (B, C, N*g, g) -> (B, N, C, g, g)
+    glimpses = F.grid_sample(image, grid, align_corners=True)
+    return glimpses.view(B, C, N, g, g).permute(0, 2, 1, 3, 4)
+
+
+def glimpse_windows(z_where, glimpse_size, img_shape):
+    """
+    Pixel windows covering the glimpses once they are pasted to full resolution.
+
+    spatial_transform(..., inverse=True) is zero everywhere except a box around each glimpse. Instead of
+    full resolution canvases, we only sample the glimpses on the pixels of these boxes. All windows have the
+    same size (the largest box in the batch) and are moved inside the image.
+
+    :param z_where: (M, 4), [sx, sy, tx, ty]
+    :param glimpse_size: size of the glimpses to paste
+    :param img_shape: (H, W)
+    :return:
+        grid: (M, h, w, 2), sampling grid for F.grid_sample(..., align_corners=True) on the glimpses
+        pixel_idx: (M, h*w), index of each window pixel into the flattened (H*W,) image
+    """
+    H, W = img_shape
+    M = z_where.size(0)
+    # (M, 2), (x, y) order
+    scale, shift = z_where[:, :2], z_where[:, 2:]
+    # Same inverse transform as spatial_transform
+    inv_scale = 1 / (scale + 1e-9)
+    size = z_where.new_tensor([W, H])
+    
+    with torch.no_grad():
+        # Bilinear sampling is nonzero up to one glimpse pixel outside the glimpse
+        extent = (scale + 1e-9) * (1 + 2 / (glimpse_size - 1))
+        # (M, 2), support in pixels
+        lo = (1 + shift - extent) * (size - 1) / 2
+        hi = (1 + shift + extent) * (size - 1) / 2
+        # Window size, with one pixel of margin on each side
+        span = (hi - lo).max(dim=0)[0] if M > 0 else torch.zeros_like(size)
+        win = torch.min(span.ceil() + 3, size)
+        win_w, win_h = int(win[0]), int(win[1])
+        # (M, 2), top left corner, such that the window is inside the image
+        start = torch.min((lo.floor() - 1).clamp(min=0), size - win)
+    
+    # (M, w), (M, h). Pixel columns and rows of each window
+    cols = start[:, :1] + torch.arange(win_w, device=z_where.device, dtype=z_where.dtype)
+    rows = start[:, 1:] + torch.arange(win_h, device=z_where.device, dtype=z_where.dtype)
+    # Normalized coordinates of these pixels, as in F.affine_grid with align_corners=True
+    u = cols * 2 / (W - 1) - 1
+    v = rows * 2 / (H - 1) - 1
+    # To glimpse coordinates
+    grid_x = inv_scale[:, :1] * u - shift[:, :1] * inv_scale[:, :1]
+    grid_y = inv_scale[:, 1:] * v - shift[:, 1:] * inv_scale[:, 1:]
+    # (M, h, w, 2)
+    grid = torch.stack((grid_x[:, None, :].expand(M, win_h, win_w),
+                        grid_y[:, :, None].expand(M, win_h, win_w)), dim=-1)
+    # (M, h*w)
+    pixel_idx = (rows.long()[:, :, None] * W + cols.long()[:, None, :]).view(M, win_h * win_w)
+    
+    return grid, pixel_idx
+
+
+def paste_windows(windows, pixel_idx, batch_idx, B, img_shape):
+    """
+    Sum windows from glimpse_windows into full resolution images. Supports autograd.
+
+    :param windows: (M, C, h, w)
+    :param pixel_idx: (M, h*w), from glimpse_windows
+    :param batch_idx: (M,), which image each window belongs to
+    :param B: number of images
+    :param img_shape: (H, W)
+    :return: (B, C, H, W)
+    """
+    M, C, h, w = windows.size()
+    H, W = img_shape
+    # (M*h*w,)
+    index = (batch_idx[:, None] * (H * W) + pixel_idx).view(-1)
+    # (M, C, h, w) -> (M*h*w, C)
+    values = windows.view(M, C, h * w).permute(0, 2, 1).reshape(M * h * w, C)
+    out = windows.new_zeros(B * H * W, C).index_add(0, index, values)
+    return out.view(B, H, W, C).permute(0, 3, 1, 2)
+
+
+def rsample(dist):
+    """
+    dist.rsample(). In a branch of run_concurrently, it first waits for the earlier branches to finish,
+    so that the noise is the same as when the branches run in sequence.
+    """
+    turn = getattr(_branch_state, 'turn', None)
+    if turn is not None:
+        turn.wait()
+    return dist.rsample()
+
+
+def run_concurrently(pool, fns):
+    """
+    Call independent functions in a thread pool, in the caller's grad mode. The results are ordinary
+    tensors in the caller's graph, whose backward is run by autograd as usual.
+
+    Each function can run until its first rsample while the earlier ones are still running, then waits
+    for them. Samples are drawn in the same order, so with the same seed the results are the same as
+    calling the functions in sequence.
+
+    :param fns: functions without arguments
+    :return: a list of their results
+    """
+    grad_enabled = torch.is_grad_enabled()
+    # Set when the function at the same position returns
+    done = [threading.Event() for _ in fns]
+
+    def call(fn, turn, done):
+        _branch_state.turn = turn
+        try:
+            # Grad mode is thread local
+            with torch.set_grad_enabled(grad_enabled):
+                return fn()
+        finally:
+            _branch_state.turn = None
+            done.set()
+
+    # Submitted in order, so a function only waits for functions that have started
+    futures = [pool.submit(call, fn, done[i - 1] if i > 0 else None, done[i]) for i, fn in enumerate(fns)]
+    return [future.result() for future in futures]
+
+
 def linear_annealing(device, step, start_step, end_step, start_value, end_value):
     """
     Linear annealing
@@ -32,11 +32,10 @@ if cfg.resume_ckpt:
 img_path = f"../data/ATARI/MsPacman-v0/train/00001.jpg"
 image = open_image(img_path).to(cfg.device)
 
-# TODO: treat global_step in a more elegant way
-loss, log = model(image, global_step=100000000)
+latents = model.encode(image)
 
 # (B, N, 4), (B, N, 1), (B, N, D)
-z_where, z_pres_prob, z_what = log['z_where'], log['z_pres_prob'], log['z_what']
+z_where, z_pres_prob, z_what = latents['z_where'], latents['z_pres_prob'], latents['z_what']
 # (B, N, 4), (B, N), (B, N)
 z_where = z_where.detach().cpu()
 
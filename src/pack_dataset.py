@@ -0,0 +1,59 @@
+# Packs the Atari PNG frames into uint8 arrays that dataset.Atari reads with packed_dataset True
+# call with python pack_dataset.py -g Pong-v0 Tennis-v0 -f train validation test
+# add --bg-colors to also build the background color tables used with black_background
+
+import argparse
+import os
+import time
+import numpy as np
+from PIL import Image
+import PIL
+from dataset.packed import pack_split, read_index, open_frames
+from dataset.bg_color import build_color_table, save_color_table
+
+parser = argparse.ArgumentParser(description='Pack Atari frames into memory-mapped uint8 arrays')
+parser.add_argument('-r', '--root', type=str, default='../data/ATARI',
+                    help='dataset root, containing one folder per game')
+parser.add_argument('-g', '--games', type=str, nargs='+', default=None,
+                    help='games to pack, all games in root if not given')
+parser.add_argument('-f', '--folders', type=str, nargs='*', default=['train', 'validation', 'test'],
+                    help='splits to pack, none with an empty -f')
+parser.add_argument('--bg-colors', action='store_true',
+                    help='build the background color table of each game from its train split')
+parser.add_argument('--num-samples', type=int, default=500,
+                    help='number of frames to build a background color table from')
+args = parser.parse_args()
+
+
+def sample_frames(root, game, mode, num_samples):
+    """
+    Evenly spaced frames of a split, from the packed array if there is one
+    """
+    if read_index(root, game, mode) is not None:
+        frames = open_frames(root, game, mode)
+        for i in np.linspace(0, len(frames) - 1, min(num_samples, len(frames))).astype(int):
+            yield frames[i]
+        return
+    image_dir = os.path.join(root, game, mode)
+    image_fn = sorted(os.listdir(image_dir))
+    for i in np.linspace(0, len(image_fn) - 1, min(num_samples, len(image_fn))).astype(int):
+        pil_img = Image.open(os.path.join(image_dir, image_fn[i])).convert('RGB')
+        yield np.asarray(pil_img.resize((128, 128), PIL.Image.BILINEAR))
+
+
+games = args.games if args.games else sorted(os.listdir(args.root))
+for game in games:
+    for folder in args.folders:
+        if not os.path.isdir(os.path.join(args.root, game, folder)):
+            print(f"Skipping {game}/{folder}, it does not exist")
+            continue
+        start = time.time()
+        index = pack_split(args.root, game, folder)
+        print(f"Packed {index['shape'][0]} frames of {game}/{folder} in {time.time() - start:.1f} sec.")
+    if args.bg_colors:
+        if not os.path.isdir(os.path.join(args.root, game, 'train')):
+            print(f"Skipping background colors of {game}, there is no train split")
+            continue
+        table = build_color_table(sample_frames(args.root, game, 'train', args.num_samples))
+        save_color_table(args.root, game, table)
+        print(f"Background colors of {game}: {table.tolist()}")
@@ -4,6 +4,8 @@ import math
 import json
 import pickle
 import os
+import atexit
+import threading
 import os.path as osp
 from collections import defaultdict, deque
 import numpy as np
@@ -37,21 +39,185 @@ def draw_bounding_boxes(image, boxes_batch, labels=None):
     _, imW, imH = image.shape
     if not torch.is_tensor(image):
         image = torch.tensor(image)
-    bb = (boxes_batch[0][:,:4] * (imW, imW, imH, imH)).round()
-    bb[:,[0, 1, 2, 3]] = bb[:,[2, 0, 3, 1]] # swapping xmin <-> ymax ... etc
+    # (N, 4), [y_min, y_max, x_min, x_max] in pixels
+    bb = torch.as_tensor(boxes_batch[0][:, :4] * (imW, imW, imH, imH)).round()
     if imW == 128 and imH == 128 and RESTORE_COLORS:
         image = torch.tensor(np.flip(image.to("cpu").numpy(), axis=0).copy())
     else:
         image = image.to("cpu")
     if labels is not None:
-        labels = label_names(labels)
-        # colors = [base_objects_colors[lab] for lab in labels]
-        colors = ["red"] * 50
-    image = draw_bb(image, torch.tensor(bb), colors=colors)
+        # box_colors = [base_objects_colors[lab] for lab in label_names(labels)]
+        box_colors = [(255, 0, 0)] * len(bb)
+    else:
+        box_colors = colors[:len(bb)]
+    box_colors = torch.tensor(box_colors, dtype=image.dtype).view(1, -1, 3)
+    image = draw_boxes(image[None], bb[None], box_colors)[0]
     return image
 
+
+def where_to_boxes(z_scale, z_shift, H, W):
+    """
+    Pixel boxes of glimpses pasted with spatial_transform(..., inverse=True)
+
+    :param z_scale: (..., 2), [sx, sy]
+    :param z_shift: (..., 2), [tx, ty] in [-1, 1]
+    :return: (..., 4), [y_min, y_max, x_min, x_max] in pixels
+    """
+    sx, sy = z_scale.unbind(dim=-1)
+    tx, ty = z_shift.unbind(dim=-1)
+    # [-1, 1] -> [0, W - 1], as with align_corners
+    boxes = torch.stack([ty - sy, ty + sy, tx - sx, tx + sx], dim=-1) + 1
+    return boxes * boxes.new_tensor([H - 1, H - 1, W - 1, W - 1]) / 2
+
+
+def draw_boxes(images, boxes, colors, present=None, thickness=1):
+    """
+    Draw box outlines into a copy of a batch of images. Only the outlines of the present boxes are
+    rasterized, all boxes at once. Where outlines overlap, one of them is drawn.
+
+    :param images: (B, C, H, W), any dtype
+    :param boxes: (B, N, 4), [y_min, y_max, x_min, x_max] in pixels, inclusive. Parts outside the
+        image are not drawn
+    :param colors: (C,), the same color for every box, or (B, N, C), in the range of images
+    :param present: (B, N) bool, the boxes to draw. All boxes if None
+    :param thickness: outline width in pixels, inside the box
+    :return: (B, C, H, W)
+    """
+    B, C, H, W = images.size()
+    N = boxes.size(1)
+    device = images.device
+    if present is None:
+        present = torch.ones(B, N, dtype=torch.bool, device=device)
+    # (M,), (M,)
+    batch_idx, box_idx = present.to(device).nonzero(as_tuple=True)
+    colors = torch.as_tensor(colors, dtype=images.dtype, device=device)
+    # (M, C)
+    colors = colors.expand(B, N, C)[batch_idx, box_idx]
+    # Each (M, 1)
+    y_min, y_max, x_min, x_max = boxes.to(device)[batch_idx, box_idx].round().long().split(1, dim=-1)
+    rows = torch.arange(H, device=device)
+    cols = torch.arange(W, device=device)
+    # (M, H) and (M, W): inside the box, and on its outline
+    in_rows = (rows >= y_min) & (rows <= y_max)
+    in_cols = (cols >= x_min) & (cols <= x_max)
+    edge_rows = in_rows & ((rows < y_min + thickness) | (rows > y_max - thickness))
+    edge_cols = in_cols & ((cols < x_min + thickness) | (cols > x_max - thickness))
+    # (M, H, W)
+    outline = (edge_rows[:, :, None] & in_cols[:, None, :]) | (in_rows[:, :, None] & edge_cols[:, None, :])
+    # (P,) each, one entry per outline pixel
+    box, y, x = outline.nonzero(as_tuple=True)
+    images = images.clone()
+    # (P, C)
+    images[batch_idx[box], :, y, x] = colors[box]
+    return images
+
+def cpu_snapshot(obj):
+    """
+    Copy of a (nested) state dict with every tensor copied to the cpu
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+def unwrap_model(model):
+    """
+    The model inside DataParallel or DistributedDataParallel
+    """
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def atomic_save(obj, path, save_fn=torch.save):
+    """
+    Write to a temporary file and rename it, so that path is never partially written
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        save_fn(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# Inference artifacts: magic, uint32 version and header length, a JSON header, then the raw tensors,
+# each aligned to ARTIFACT_ALIGN bytes
+ARTIFACT_MAGIC = b'SPACEINF'
+ARTIFACT_VERSION = 1
+ARTIFACT_ALIGN = 64
+ARTIFACT_EXT = '.space'
+
+
+def export_artifact(path, model, epoch, global_step):
+    """
+    Write the weights of a Space model, without optimizer states and legacy placeholders
+    """
+    model = unwrap_model(model)
+    state_dict = {k: v.detach().cpu().contiguous() for k, v in model.inference_state_dict().items()}
+
+    align = lambda n: (n + ARTIFACT_ALIGN - 1) // ARTIFACT_ALIGN * ARTIFACT_ALIGN
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        tensors.append({
+            'name': name,
+            'dtype': str(tensor.dtype).replace('torch.', ''),
+            'shape': list(tensor.shape),
+            'offset': offset,
+        })
+        offset = align(offset + nbytes)
+    header = json.dumps({'epoch': epoch, 'global_step': global_step, 'tensors': tensors}).encode()
+    prefix = ARTIFACT_MAGIC + np.array([ARTIFACT_VERSION, len(header)], dtype=np.uint32).tobytes() + header
+    data_start = align(len(prefix))
+
+    def write(_, f):
+        f.write(prefix.ljust(data_start, b'\0'))
+        for info, tensor in zip(tensors, state_dict.values()):
+            f.seek(data_start + info['offset'])
+            f.write(tensor.numpy().tobytes())
+
+    atomic_save(None, path, write)
+    print(f'Inference artifact has been saved to "{path}".')
+
+
+def is_artifact(path):
+    with open(path, 'rb') as f:
+        return f.read(len(ARTIFACT_MAGIC)) == ARTIFACT_MAGIC
+
+
+def load_artifact(path):
+    """
+    Memory map an inference artifact. Tensors are views into the file, so only what is used gets read
+
+    :return: state_dict, epoch, global_step
+    """
+    # Copy-on-write, so that the tensors are writable but the file is never changed
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    assert bytes(data[:len(ARTIFACT_MAGIC)]) == ARTIFACT_MAGIC, f'{path} is not an inference artifact'
+    version, header_len = np.frombuffer(data, dtype=np.uint32, count=2, offset=len(ARTIFACT_MAGIC))
+    if version != ARTIFACT_VERSION:
+        raise ValueError(f'Unsupported inference artifact version {version} in {path}')
+    header_start = len(ARTIFACT_MAGIC) + 8
+    header = json.loads(bytes(data[header_start:header_start + header_len]))
+    data_start = (header_start + header_len + ARTIFACT_ALIGN - 1) // ARTIFACT_ALIGN * ARTIFACT_ALIGN
+
+    state_dict = {}
+    for info in header['tensors']:
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape']))
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=data_start + info['offset'])
+        state_dict[info['name']] = torch.from_numpy(array).view(info['shape'])
+    return state_dict, header['epoch'], header['global_step']
+
+
 class Checkpointer:
-    def __init__(self, checkpointdir, max_num):
+    def __init__(self, checkpointdir, max_num, async_save=False):
         self.max_num = max_num
         self.checkpointdir = checkpointdir
         if not osp.exists(checkpointdir):
@@ -59,47 +225,92 @@ class Checkpointer:
         self.listfile = osp.join(checkpointdir, 'model_list.pkl')
 
         if not osp.exists(self.listfile):
-            with open(self.listfile, 'wb') as f:
-                model_list = []
-                pickle.dump(model_list, f)
-
-    def save(self, path: str, model, optimizer_fg, optimizer_bg, epoch, global_step):
-        assert path.endswith('.pth')
-        os.makedirs(osp.dirname(path), exist_ok=True)
-
-        if isinstance(model, nn.DataParallel):
-            model = model.module
-        checkpoint = {
+            atomic_save([], self.listfile, pickle.dump)
+
+        # With async_save, save_last only takes a cpu snapshot and a thread writes it. At most one save is
+        # in flight
+        self.async_save = async_save
+        self.pending = None
+        if async_save:
+            atexit.register(self.wait)
+
+    def make_checkpoint(self, model, optimizer_fg, optimizer_bg, epoch, global_step):
+        model = unwrap_model(model)
+        return {
             'model': model.state_dict(),
             'optimizer_fg': optimizer_fg.state_dict() if optimizer_fg else None,
             'optimizer_bg': optimizer_bg.state_dict() if optimizer_bg else None,
             'epoch': epoch,
             'global_step': global_step
         }
-        with open(path, 'wb') as f:
-            torch.save(checkpoint, f)
-            print(f'Checkpoint has been saved to "{path}".')
+
+    def save(self, path: str, model, optimizer_fg, optimizer_bg, epoch, global_step):
+        assert path.endswith('.pth')
+        os.makedirs(osp.dirname(path), exist_ok=True)
+
+        checkpoint = self.make_checkpoint(model, optimizer_fg, optimizer_bg, epoch, global_step)
+        atomic_save(checkpoint, path)
+        print(f'Checkpoint has been saved to "{path}".')
 
     def save_last(self, model, optimizer_fg, optimizer_bg, epoch, global_step):
         path = osp.join(self.checkpointdir, 'model_{:09}.pth'.format(global_step + 1))
 
-        with open(self.listfile, 'rb+') as f:
+        if not self.async_save:
+            checkpoint = self.make_checkpoint(model, optimizer_fg, optimizer_bg, epoch, global_step)
+            self.write_last(path, checkpoint)
+            return
+
+        # Only one save in flight, and the snapshot must not change while it is written
+        self.wait()
+        checkpoint = cpu_snapshot(self.make_checkpoint(model, optimizer_fg, optimizer_bg, epoch, global_step))
+        self.pending = threading.Thread(target=self.write_last, args=(path, checkpoint))
+        self.pending.start()
+
+    def write_last(self, path, checkpoint):
+        """
+        Write the checkpoint, then the list, then prune. Each step is atomic, so after a crash the list
+        only names complete checkpoints
+        """
+        atomic_save(checkpoint, path)
+        with open(self.listfile, 'rb') as f:
             model_list = pickle.load(f)
-            if len(model_list) >= self.max_num:
-                if osp.exists(model_list[0]):
-                    os.remove(model_list[0])
-                del model_list[0]
-            model_list.append(path)
-        with open(self.listfile, 'rb+') as f:
-            pickle.dump(model_list, f)
-        self.save(path, model, optimizer_fg, optimizer_bg, epoch, global_step)
-
-    def load(self, path, model, optimizer_fg, optimizer_bg, use_cpu=False):
+        model_list.append(path)
+        pruned = model_list[:max(len(model_list) - self.max_num, 0)]
+        model_list = model_list[len(pruned):]
+        atomic_save(model_list, self.listfile, pickle.dump)
+        for old_path in pruned:
+            if osp.exists(old_path) and old_path not in model_list:
+                os.remove(old_path)
+        print(f'Checkpoint has been saved to "{path}".')
+
+    def wait(self):
+        """
+        Wait for the save in flight, if any
+        """
+        if self.pending is not None:
+            self.pending.join()
+            self.pending = None
+
+    def load(self, path, model, optimizer_fg, optimizer_bg, use_cpu=False, use_artifact=True):
         """
         Return starting epoch and global step
+
+        If no optimizer is loaded, an inference artifact (see export_artifact) is used instead of the
+        checkpoint when there is an up to date one next to it
         """
 
         assert osp.exists(path), f'Checkpoint {path} does not exist.'
+        if use_artifact and not optimizer_fg and not optimizer_bg:
+            # Use an up to date inference artifact if there is one
+            artifact = osp.splitext(path)[0] + ARTIFACT_EXT
+            if osp.exists(artifact) and osp.getmtime(artifact) >= osp.getmtime(path):
+                path = artifact
+            if is_artifact(path):
+                print('Loading inference artifact from {}...'.format(path))
+                state_dict, epoch, global_step = load_artifact(path)
+                model.load_inference_state_dict(state_dict)
+                print('Checkpoint loaded.')
+                return {'epoch': epoch, 'global_step': global_step}
         print('Loading checkpoint from {}...'.format(path))
         if not use_cpu:
             if torch.cuda.device_count() == 1:
@@ -123,16 +334,24 @@ class Checkpointer:
         """
 
         if path == '':
-            with open(self.listfile, 'rb') as f:
-                model_list = pickle.load(f)
-                if len(model_list) == 0:
-                    print('No checkpoint found. Starting from scratch')
-                    return None
-                else:
-                    path = model_list[-1]
+            path = self.last_checkpoint()
+            if path is None:
+                print('No checkpoint found. Starting from scratch')
+                return None
 
         return self.load(path, model, optimizer_fg, optimizer_bg, use_cpu)
 
+    def last_checkpoint(self):
+        """
+        :return: path of the last checkpoint, None if there is none
+        """
+        self.wait()
+        with open(self.listfile, 'rb') as f:
+            model_list = pickle.load(f)
+        # Checkpoints listed by older versions might have been written partially
+        model_list = [p for p in model_list if osp.exists(p)]
+        return model_list[-1] if model_list else None
+
     def save_best(self, metric_name, value, checkpoint,  min_is_better):
         metric_file = os.path.join(self.checkpointdir, f'best_{metric_name}.json')
         checkpoint_file = os.path.join(self.checkpointdir, f'best_{metric_name}.pth')
@@ -1,7 +1,8 @@
-__all__ = ['get_vislogger']
+__all__ = ['get_vislogger', 'AsyncVis']
 
 from .space_vis import SpaceVis
+from .async_vis import AsyncVis
 def get_vislogger(cfg):
     if cfg.model == 'SPACE':
-        return SpaceVis()
+        return SpaceVis(vis_size=cfg.train.vis_size)
     return None
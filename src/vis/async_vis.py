@@ -0,0 +1,55 @@
+import queue
+import threading
+import traceback
+
+
+class AsyncVis:
+    """
+    Writes the training visualization on a background thread, so that training doesn't wait for the
+    rendering and the TensorBoard writes.
+
+    submit only takes a cpu snapshot of the part of the log that is needed. If the worker is still busy
+    with max_queue earlier snapshots, the new one is dropped.
+    """
+
+    def __init__(self, vis_logger, writer, max_queue=2):
+        self.vis_logger = vis_logger
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self.worker, name='space-vis', daemon=True)
+        self.thread.start()
+
+    def submit(self, log, global_step, mode, num_batch=10):
+        """
+        :return: whether the snapshot was queued
+        """
+        # Only the training thread puts, so the queue can't fill up between here and put_nowait
+        if self.queue.full():
+            print(f'Visualization is busy, skipping step {global_step}.')
+            return False
+        self.queue.put_nowait((self.vis_logger.snapshot(log, num_batch), global_step, mode))
+        return True
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            snapshot, global_step, mode = job
+            # A failed step must not stop the worker, or the queue fills up and close blocks
+            try:
+                self.vis_logger.write_train_vis(self.writer, snapshot, global_step, mode)
+            except Exception:
+                print(f'Visualization of step {global_step} failed:')
+                traceback.print_exc()
+
+    def close(self):
+        """
+        Write the queued snapshots and stop the worker
+        """
+        if self.thread is None:
+            return
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
@@ -7,29 +7,61 @@ import matplotlib
 matplotlib.use('Agg')
 
 from utils import spatial_transform
-from .utils import bbox_in_one, colored_bbox_in_one_image
+from dataset import preprocess_batch, preprocess_flags
+from .utils import bbox_in_one, colored_bbox_in_one_image, resize_images
 from attrdict import AttrDict
 from torchvision.utils import make_grid
 from torch.utils.data import Subset, DataLoader
 import matplotlib.pyplot as plt
 
 
+# Entries of the log used by train_vis
+VIS_KEYS = [
+    'imgs', 'y', 'fg', 'bg', 'comps', 'masks', 'alpha_map', 'z_pres', 'z_scale', 'z_shift',
+    'mse', 'log_like', 'kl_z_what', 'kl_z_where', 'kl_z_pres', 'kl_z_depth', 'kl_bg', 'boundary_loss', 'loss',
+]
+# Images among them, resized to vis_size
+VIS_IMAGE_KEYS = ['imgs', 'y', 'fg', 'bg', 'comps', 'masks', 'alpha_map']
+
+
 class SpaceVis:
-    def __init__(self):
-        pass
+    def __init__(self, vis_size=0):
+        """
+        :param vis_size: resolution of the images written by train_vis. 0 for the input resolution
+        """
+        self.vis_size = vis_size
 
 
     @torch.no_grad()
     def train_vis(self, writer: SummaryWriter, log, global_step, mode, num_batch=10):
         """
         """
-        B = num_batch
+        self.write_train_vis(writer, self.snapshot(log, num_batch), global_step, mode)
 
-        for key, value in log.items():
+    @torch.no_grad()
+    def snapshot(self, log, num_batch=10):
+        """
+        Cpu copy of the part of a log that train_vis needs, for the first num_batch images. Images are
+        resized to vis_size before leaving the device.
+        """
+        snapshot = {}
+        for key in VIS_KEYS:
+            value = log[key]
             if isinstance(value, torch.Tensor):
-                log[key] = value.detach().cpu()
-                if isinstance(log[key], torch.Tensor) and log[key].ndim > 0:
-                    log[key] = log[key][:num_batch]
+                value = value.detach()
+                if value.ndim > 0:
+                    value = value[:num_batch]
+                if key in VIS_IMAGE_KEYS and self.vis_size:
+                    value = resize_images(value, self.vis_size)
+                value = value.cpu()
+            snapshot[key] = value
+        return snapshot
+
+    @torch.no_grad()
+    def write_train_vis(self, writer: SummaryWriter, log, global_step, mode):
+        """
+        Write a snapshot taken by snapshot
+        """
         log = AttrDict(log)
 
         # (B, 3, H, W)
@@ -65,8 +97,8 @@ class SpaceVis:
         grid_image = make_grid(log.bg, 5, normalize=False, pad_value=1)
         writer.add_image(f'{mode}/3-background', grid_image, global_step)
 
-        mse = (log.y - log.imgs) ** 2
-        mse = mse.flatten(start_dim=1).sum(dim=1).mean(dim=0)
+        # At the input resolution
+        mse = log.mse.mean(dim=0)
         log_like, kl_z_what, kl_z_where, kl_z_pres, kl_z_depth, kl_bg = (
             log['log_like'].mean(), log['kl_z_what'].mean(), log['kl_z_where'].mean(),
             log['kl_z_pres'].mean(), log['kl_z_depth'].mean(), log['kl_bg'].mean()
@@ -88,10 +120,11 @@ class SpaceVis:
 
     @torch.no_grad()
     def show_vis(self, model, dataset, indices, path, device):
+        flags = preprocess_flags(dataset)
         dataset = Subset(dataset, indices)
         dataloader = DataLoader(dataset, batch_size=len(indices), shuffle=False)
         data = next(iter(dataloader))
-        data = data.to(device)
+        data = preprocess_batch(data, device, **flags)
         loss, log = model(data, 100000000)
         for key, value in log.items():
             if isinstance(value, torch.Tensor):
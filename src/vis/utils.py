@@ -1,7 +1,8 @@
 import torch
+import torch.nn.functional as F
 import matplotlib
 matplotlib.use('agg')
-from utils import spatial_transform
+from utils import spatial_transform, where_to_boxes, draw_boxes
 
 
 rbox = torch.zeros(3, 21, 21)
@@ -59,6 +60,8 @@ pbox[2, :, -2:] = 1
 pbox = pbox.view(1, 3, 21, 21)
 
 boxes = torch.cat((rbox, gbox, blbox, ybox, abox, pbox))
+# Outline colors of the boxes above, in the same order
+box_colors = torch.tensor([[1., 0., 0.], [0., 1., 0.], [0., 0., 1.], [1., 1., 0.], [0., 1., 1.], [1., 0., 1.]])
 
 
 def visualize(x, z_pres, z_where_scale, z_where_shift, rbox=rbox, gbox=gbox, num_obj=8 * 8):
@@ -98,38 +101,52 @@ def add_bbox(x, score, z_where_scale, z_where_shift, rbox=rbox, gbox=gbox, num_o
     return bbox
 
 
-def bbox_in_one(x, z_pres, z_where_scale, z_where_shift, gbox=gbox):
-    B, _, *img_shape = x.size()
-    B, N, _ = z_pres.size()
-    z_pres = z_pres.view(-1, 1, 1, 1)
-    z_scale = z_where_scale.reshape(-1, 2)
-    z_shift = z_where_shift.reshape(-1, 2)
-    # argmax_cluster = argmax_cluster.view(-1, 1, 1, 1)
-    # kbox = boxes[argmax_cluster.view(-1)]
-    bbox = spatial_transform(z_pres * gbox,  # + (1 - z_pres) * rbox,
-                             torch.cat((z_scale, z_shift), dim=1),
-                             torch.Size([B * N, 3, *img_shape]),
-                             inverse=True)
-    bbox = (bbox.view(B, N, 3, *img_shape).sum(dim=1).clamp(0.0, 1.0) + x).clamp(0.0, 1.0)
-    return bbox
+def bbox_in_one(x, z_pres, z_where_scale, z_where_shift):
+    """
+    Green outlines of the present boxes
 
-def colored_bbox_in_one_image(x, z_pres, z_where_scale, z_where_shift, gbox=gbox):
-    B, _, *img_shape = x.size()
-    B, N, _ = z_pres.size()
-    z_pres = z_pres.view(-1, 1, 1, 1)
-    z_scale = z_where_scale.reshape(-1, 2)
-    z_shift = z_where_shift.reshape(-1, 2)
-    # argmax_cluster = argmax_cluster.view(-1, 1, 1, 1)
-    # kbox = boxes[argmax_cluster.view(-1)]
-    import ipdb; ipdb.set_trace()
-    bbox = spatial_transform(z_pres * gbox,  # + (1 - z_pres) * rbox,
-                             torch.cat((z_scale, z_shift), dim=1),
-                             torch.Size([B * N, 3, *img_shape]),
-                             inverse=True)
+    :param x: (B, 3, H, W)
+    :param z_pres: (B, N, 1)
+    :param z_where_scale: (B, N, 2)
+    :param z_where_shift: (B, N, 2)
+    :return: (B, 3, H, W)
+    """
+    B, _, H, W = x.size()
+    # (B, N, 4)
+    bbox = where_to_boxes(z_where_scale, z_where_shift, H, W)
+    return draw_boxes(x, bbox, box_colors[1], present=z_pres.view(B, -1) > 0.5)
 
-    bbox = bbox.view(B, N, 3, *img_shape).sum(dim=1).clamp(0.0, 1.0)
-    bbox = (bbox + x).clamp(0.0, 1.0)
-    return bbox
+def resize_images(x, size):
+    """
+    Area interpolation to a square resolution
+
+    :param x: (..., C, H, W)
+    :return: (..., C, size, size)
+    """
+    *shape, C, H, W = x.size()
+    if H == size and W == size:
+        return x
+    x = F.interpolate(x.reshape(-1, C, H, W), size=(size, size), mode='area')
+    return x.view(*shape, C, size, size)
+
+
+def colored_bbox_in_one_image(x, z_pres, z_where_scale, z_where_shift):
+    """
+    Outlines of the present boxes, colored by cell
+
+    :param x: (B, 3, H, W)
+    :param z_pres: (B, N, 1)
+    :param z_where_scale: (B, N, 2)
+    :param z_where_shift: (B, N, 2)
+    :return: (B, 3, H, W)
+    """
+    B, _, H, W = x.size()
+    N = z_pres.size(1)
+    # (B, N, 3)
+    cell_colors = box_colors[torch.arange(N) % len(box_colors)].expand(B, N, 3)
+    # (B, N, 4)
+    bbox = where_to_boxes(z_where_scale, z_where_shift, H, W)
+    return draw_boxes(x, bbox, cell_colors, present=z_pres.view(B, -1) > 0.5)
 
 
 